@@ -0,0 +1,73 @@
+""" Задержка отдельных запросов к запущенному приложению: /nodes (без кэша и из кэша), /node/{id}/statistic,
+/delete, а также ответы 404. Каталог синтезируется через /imports: в корне --categories категорий
+по --offers товаров, цены товаров обновляются --updates раз.
+
+    python benchmarks/endpoints.py [--url http://localhost:80] [--categories 20] [--offers 20] [--updates 5]
+"""
+import argparse
+import statistics
+from datetime import datetime, timedelta
+from time import perf_counter
+from uuid import uuid4
+
+import requests
+
+
+def iso(date: datetime) -> str:
+    return date.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def measure(session: requests.Session, method: str, urls, status: int) -> list:
+    times = []
+    for url in urls:
+        started = perf_counter()
+        response = session.request(method, url)
+        times.append(perf_counter() - started)
+        assert response.status_code == status, (url, response.status_code, response.text)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк задержки запросов')
+    parser.add_argument('--url', default='http://localhost:80')
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--offers', type=int, default=20, help='Товаров в каждой категории')
+    parser.add_argument('--updates', type=int, default=5, help='Сколько раз обновляются цены товаров')
+    args = parser.parse_args()
+
+    session = requests.Session()
+    root = str(uuid4())
+    categories = [str(uuid4()) for _ in range(args.categories)]
+    offers = {category: [str(uuid4()) for _ in range(args.offers)] for category in categories}
+    date = datetime(2022, 6, 1, 12)
+    items = [{'id': root, 'name': 'Корень', 'type': 'CATEGORY', 'parentId': None}]
+    items += [{'id': category, 'name': 'Категория', 'type': 'CATEGORY', 'parentId': root} for category in categories]
+    for update in range(args.updates):
+        items += [{'id': offer, 'name': 'Товар', 'type': 'OFFER', 'parentId': category, 'price': update * 10 + i}
+                  for category in categories for i, offer in enumerate(offers[category])]
+        response = session.post(f'{args.url}/imports', json={'items': items, 'updateDate': iso(date)})
+        assert response.status_code == 200, response.text
+        date += timedelta(hours=1)
+        items = []
+
+    all_offers = [offer for category in categories for offer in offers[category]]
+    missing = [str(uuid4()) for _ in all_offers]
+    cases = [
+        ('GET /nodes (без кэша)', 'GET', [f'{args.url}/nodes/{category}' for category in categories], 200),
+        ('GET /nodes (из кэша)', 'GET', [f'{args.url}/nodes/{category}' for category in categories], 200),
+        ('GET /nodes 404', 'GET', [f'{args.url}/nodes/{item}' for item in missing], 404),
+        ('GET /node/{id}/statistic', 'GET', [f'{args.url}/node/{offer}/statistic' for offer in all_offers], 200),
+        ('GET /node/{id}/statistic 404', 'GET', [f'{args.url}/node/{item}/statistic' for item in missing], 404),
+        ('DELETE /delete', 'DELETE', [f'{args.url}/delete/{offer}' for offer in all_offers], 200),
+        ('DELETE /delete 404', 'DELETE', [f'{args.url}/delete/{item}' for item in missing], 404),
+    ]
+    print(f'{"запрос":32} {"запросов":>9} {"p50, мс":>9} {"среднее, мс":>12}')
+    for name, method, urls, status in cases:
+        times = measure(session, method, urls, status)
+        print(f'{name:32} {len(times):9} {statistics.median(times) * 1000:9.2f} '
+              f'{statistics.mean(times) * 1000:12.2f}')
+    session.delete(f'{args.url}/delete/{root}')
+
+
+if __name__ == '__main__':
+    main()
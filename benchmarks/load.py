@@ -0,0 +1,327 @@
+""" Нагрузочный тест запущенного приложения. Строит синтетический каталог (дерево категорий глубины --depth
+с --fanout подкатегориями и --offers товарами в каждой категории нижнего уровня), затем --duration секунд
+с заданной частотой --rate отправляет смесь запросов --mix и выводит p50/p95/p99 и пропускную способность
+по каждому виду запросов. Запросы отправляются по расписанию, не дожидаясь ответов на предыдущие
+(не больше --concurrency одновременно), задержка отсчитывается от запланированного момента отправки.
+
+    python benchmarks/load.py [--url http://localhost:80] [--rate 200] [--duration 30] \
+        [--mix nodes=50,statistic=20,sales=10,imports=15,delete=5] [--output load.json] [--compare baseline.json]
+
+С --output результаты сохраняются в JSON; с --compare сравниваются с сохраненными ранее, и запросы,
+у которых p95 или p99 выросли либо пропускная способность упала больше чем на --threshold, отмечаются
+как регрессия (код возврата 1). Одинаковый --seed дает тот же каталог и ту же последовательность запросов.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+from uuid import UUID
+
+ENDPOINTS = ('imports', 'nodes', 'statistic', 'sales', 'delete')
+
+
+class HTTPConnection(object):
+    """ Минимальный клиент HTTP/1.1 с keep-alive: нагрузочному тесту не нужны зависимости сверх requirements.txt """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b'') -> Tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        head = f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Length: {len(body)}\r\n'
+        if body:
+            head += 'Content-Type: application/json\r\n'
+        self.writer.write(head.encode() + b'\r\n' + body)
+        try:
+            return await self.read_response()
+        except Exception:
+            self.close()
+            raise
+
+    async def read_response(self) -> Tuple[int, bytes]:
+        status = int((await self.reader.readuntil(b'\r\n')).split()[1])
+        headers = dict()
+        while True:
+            line = await self.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunks.append(await self.reader.readexactly(size + 2))
+                if size == 0:
+                    break
+            body = b''.join(chunk[:-2] for chunk in chunks)
+        else:
+            body = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection') == 'close':
+            self.close()
+        return status, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class Catalog(object):
+    """ Синтетическое дерево категорий и товаров и состояние, которое меняют импорты и удаления """
+
+    def __init__(self, rnd: random.Random, roots: int, depth: int, fanout: int, offers: int):
+        self.rnd = rnd
+        self.fanout = fanout
+        self.categories: List[dict] = []
+        self.leaves: List[str] = []
+        self.offers: Dict[str, dict] = dict()
+        self.deleted: List[str] = []
+        self.roots = [self.add_category(None, depth) for _ in range(roots)]
+        for leaf in self.leaves:
+            for _ in range(offers):
+                offer = self.new_id()
+                self.offers[offer] = {'id': offer, 'name': 'Товар', 'type': 'OFFER', 'parentId': leaf,
+                                      'price': rnd.randint(1, 100000)}
+        self.live = list(self.offers)
+        self.date = datetime(2022, 6, 1, tzinfo=timezone.utc)
+
+    def new_id(self) -> str:
+        return str(UUID(int=self.rnd.getrandbits(128), version=4))
+
+    def add_category(self, parent, depth: int) -> str:
+        category = self.new_id()
+        self.categories.append({'id': category, 'name': 'Категория', 'type': 'CATEGORY', 'parentId': parent})
+        if depth > 1:
+            for _ in range(self.fanout):
+                self.add_category(category, depth - 1)
+        else:
+            self.leaves.append(category)
+        return category
+
+    def next_date(self) -> str:
+        self.date += timedelta(minutes=1)
+        return self.date.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def import_batches(self, size: int):
+        """ Весь каталог пачками импортов; родители идут раньше потомков """
+        items = self.categories + list(self.offers.values())
+        for start in range(0, len(items), size):
+            yield {'items': items[start:start + size], 'updateDate': self.next_date()}
+
+    def random_offer(self) -> str:
+        return self.rnd.choice(self.live)
+
+    def price_update(self, size: int) -> dict:
+        """ Новые цены случайных товаров; удаленные ранее товары создаются заново """
+        ids = set(self.rnd.choice(self.live) for _ in range(size))
+        if self.deleted:
+            offer = self.deleted.pop()
+            self.live.append(offer)
+            ids.add(offer)
+        items = []
+        for offer in ids:
+            self.offers[offer]['price'] = self.rnd.randint(1, 100000)
+            items.append(self.offers[offer])
+        return {'items': items, 'updateDate': self.next_date()}
+
+    def delete_offer(self) -> str:
+        offer = self.live.pop(self.rnd.randrange(len(self.live)))
+        self.deleted.append(offer)
+        return offer
+
+
+def percentile(values: List[float], p: float) -> float:
+    """ Перцентиль по ближайшему рангу в отсортированном списке """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+class LoadTest(object):
+    def __init__(self, args, catalog: Catalog, rnd: random.Random):
+        url = urlsplit(args.url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.args = args
+        self.catalog = catalog
+        self.rnd = rnd
+        self.connections: asyncio.Queue = asyncio.Queue()
+        for _ in range(args.concurrency):
+            self.connections.put_nowait(HTTPConnection(self.host, self.port))
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def call(self, method: str, path: str, body: bytes = b'') -> Tuple[int, bytes]:
+        connection = await self.connections.get()
+        try:
+            return await connection.request(method, path, body)
+        finally:
+            self.connections.put_nowait(connection)
+
+    async def setup(self):
+        for batch in self.catalog.import_batches(self.args.batch):
+            status, body = await self.call('POST', '/imports', json.dumps(batch).encode())
+            if status != 200:
+                raise RuntimeError(f'Импорт каталога: {status} {body[:200]}')
+
+    async def cleanup(self):
+        for root in self.catalog.roots:
+            await self.call('DELETE', f'/delete/{root}')
+
+    def next_request(self) -> Tuple[str, str, str, bytes]:
+        endpoint = self.rnd.choices(list(self.args.mix), weights=list(self.args.mix.values()))[0]
+        catalog = self.catalog
+        if endpoint == 'delete' and len(catalog.live) < 2:
+            endpoint = 'nodes'
+        if endpoint == 'imports':
+            body = json.dumps(catalog.price_update(self.args.import_size)).encode()
+            return endpoint, 'POST', '/imports', body
+        if endpoint == 'nodes':
+            if self.rnd.random() < 0.1:
+                return endpoint, 'GET', f'/nodes/{self.rnd.choice(catalog.roots)}', b''
+            if self.rnd.random() < 0.5:
+                return endpoint, 'GET', f'/nodes/{self.rnd.choice(catalog.leaves)}', b''
+            return endpoint, 'GET', f'/nodes/{catalog.random_offer()}', b''
+        if endpoint == 'statistic':
+            return endpoint, 'GET', f'/node/{catalog.random_offer()}/statistic', b''
+        if endpoint == 'sales':
+            return endpoint, 'GET', f'/sales?date={catalog.date.strftime("%Y-%m-%dT%H:%M:%S.000Z")}', b''
+        return endpoint, 'DELETE', f'/delete/{catalog.delete_offer()}', b''
+
+    async def send(self, endpoint: str, method: str, path: str, body: bytes, scheduled: float):
+        try:
+            status, _ = await self.call(method, path, body)
+        except Exception:
+            self.errors[endpoint] += 1
+            return
+        self.latencies[endpoint].append(perf_counter() - scheduled)
+        self.statuses[endpoint][status] += 1
+        if status >= 500:
+            self.errors[endpoint] += 1
+
+    async def run(self) -> float:
+        interval = 1 / self.args.rate
+        tasks = []
+        started = perf_counter()
+        for number in range(int(self.args.rate * self.args.duration)):
+            scheduled = started + number * interval
+            delay = scheduled - perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self.send(*self.next_request(), scheduled)))
+        await asyncio.gather(*tasks)
+        return perf_counter() - started
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = dict()
+        for endpoint in ENDPOINTS:
+            latencies = sorted(self.latencies[endpoint])
+            if not latencies and not self.errors[endpoint]:
+                continue
+            endpoints[endpoint] = {
+                'requests': len(latencies) + self.errors[endpoint],
+                'errors': self.errors[endpoint],
+                'statuses': {str(status): count for status, count in sorted(self.statuses[endpoint].items())},
+                'throughput': round(len(latencies) / elapsed, 2),
+                'p50': round(percentile(latencies, 50) * 1000, 2),
+                'p95': round(percentile(latencies, 95) * 1000, 2),
+                'p99': round(percentile(latencies, 99) * 1000, 2),
+                'max': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            }
+        return endpoints
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """ Регрессии относительно baseline: рост p95/p99 или падение пропускной способности больше чем на threshold """
+    regressions = []
+    for endpoint, stats in current.items():
+        before = baseline.get(endpoint)
+        if before is None:
+            continue
+        for key in ('p95', 'p99'):
+            if before[key] and stats[key] > before[key] * (1 + threshold):
+                regressions.append(f'{endpoint}: {key} {before[key]} -> {stats[key]} мс')
+        if before['throughput'] and stats['throughput'] < before['throughput'] * (1 - threshold):
+            regressions.append(f'{endpoint}: пропускная способность {before["throughput"]} -> '
+                               f'{stats["throughput"]} запросов/с')
+    return regressions
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = dict()
+    for part in value.split(','):
+        endpoint, weight = part.split('=')
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f'Неизвестный запрос {endpoint}, допустимы: {", ".join(ENDPOINTS)}')
+        mix[endpoint] = float(weight)
+    return mix
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест MegaMarket API')
+    parser.add_argument('--url', default='http://localhost:80')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--roots', type=int, default=2, help='Корневых категорий')
+    parser.add_argument('--depth', type=int, default=3, help='Уровней категорий')
+    parser.add_argument('--fanout', type=int, default=5, help='Подкатегорий у каждой категории')
+    parser.add_argument('--offers', type=int, default=20, help='Товаров в каждой категории нижнего уровня')
+    parser.add_argument('--batch', type=int, default=1000, help='Элементов в импорте при построении каталога')
+    parser.add_argument('--rate', type=float, default=200, help='Запросов в секунду')
+    parser.add_argument('--duration', type=float, default=30, help='Секунд нагрузки')
+    parser.add_argument('--concurrency', type=int, default=64, help='Наибольшее число одновременных запросов')
+    parser.add_argument('--mix', type=parse_mix, default='nodes=50,statistic=20,sales=10,imports=15,delete=5')
+    parser.add_argument('--import-size', type=int, default=10, help='Товаров в импорте при нагрузке')
+    parser.add_argument('--output', help='Сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON с результатами предыдущего запуска')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Допустимое ухудшение, доля')
+    parser.add_argument('--keep', action='store_true', help='Не удалять каталог после теста')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    catalog = Catalog(rnd, args.roots, args.depth, args.fanout, args.offers)
+    test = LoadTest(args, catalog, rnd)
+    await test.setup()
+    print(f'Каталог: {len(catalog.categories)} категорий, {len(catalog.offers)} товаров')
+    try:
+        elapsed = await test.run()
+    finally:
+        if not args.keep:
+            await test.cleanup()
+    endpoints = test.report(elapsed)
+
+    print(f'{"запрос":10} {"всего":>7} {"ошибок":>7} {"в секунду":>10} {"p50, мс":>9} {"p95, мс":>9} '
+          f'{"p99, мс":>9} {"max, мс":>9}')
+    for endpoint, stats in endpoints.items():
+        print(f'{endpoint:10} {stats["requests"]:7} {stats["errors"]:7} {stats["throughput"]:10.1f} '
+              f'{stats["p50"]:9.2f} {stats["p95"]:9.2f} {stats["p99"]:9.2f} {stats["max"]:9.2f}')
+    total = sum(stats['requests'] for stats in endpoints.values())
+    print(f'Всего {total} запросов за {elapsed:.1f} с')
+
+    if args.output:
+        config = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+        result = {'date': datetime.now(timezone.utc).isoformat(), 'config': config, 'elapsed': round(elapsed, 3),
+                  'endpoints': endpoints}
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(result, output, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline:
+            regressions = compare(endpoints, json.load(baseline)['endpoints'], args.threshold)
+        for regression in regressions:
+            print(f'РЕГРЕССИЯ {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+""" Сравнение сериализации ответов /nodes и /node/{id}/statistic: через pydantic-модели
+(как FastAPI сериализует возвращенную модель) и напрямую из записей asyncpg через orjson.
+Записи синтезируются запросом к PostgreSQL, таблицы приложения не нужны.
+
+    python benchmarks/serialization.py [--categories 100] [--offers 100] [--repeat 5]
+"""
+import argparse
+import asyncio
+import os
+import sys
+from time import perf_counter
+from uuid import uuid4
+
+import asyncpg
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import models  # noqa: E402
+import serialization  # noqa: E402
+
+SUBTREE = '''
+WITH cats AS (SELECT gen_random_uuid() AS id, g FROM generate_series(1, $2) AS g)
+SELECT $1::uuid AS id, 'Корень' AS name, now() AS date, NULL::uuid AS "parentId", 'CATEGORY' AS type, 100 AS price
+UNION ALL
+SELECT id, 'Категория ' || g, now(), $1::uuid, 'CATEGORY', 100 FROM cats
+UNION ALL
+SELECT gen_random_uuid(), 'Товар ' || o, now() - o * interval '1 minute', cats.id, 'OFFER', o 
+FROM cats, generate_series(1, $3) AS o;
+'''
+
+HISTORY = '''
+SELECT $1::uuid AS id, 'Товар' AS name, NULL::uuid AS "parentId", 'OFFER' AS type, g AS price, 
+    now() - g * interval '1 minute' AS date, g AS history_id 
+FROM generate_series(1, $2) AS g;
+'''
+
+
+def pydantic_subtree(records, root) -> bytes:
+    units = dict()
+    for record in records:
+        children = list() if record['type'] == models.ShopUnitType.category else None
+        units[record['id']] = models.ShopUnit(**record, children=children)
+    for record in records:
+        if record['id'] != root:
+            units[record['parentId']].children.append(units[record['id']])
+    return JSONResponse(content=jsonable_encoder(units[root])).body
+
+
+def pydantic_statistic(records) -> bytes:
+    return JSONResponse(content=jsonable_encoder(models.ShopUnitStatisticResponse(items=records))).body
+
+
+def measure(func, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        started = perf_counter()
+        func()
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк сериализации ответов')
+    parser.add_argument('--categories', type=int, default=100)
+    parser.add_argument('--offers', type=int, default=100, help='Товаров в каждой категории')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    env = models.EnvSettings()
+    connection = await asyncpg.connect(host=env.postgres_host, port=env.postgres_port, user=env.postgres_user,
+                                       password=env.postgres_password, database=env.postgres_db)
+    root = uuid4()
+    subtree = await connection.fetch(SUBTREE, root, args.categories, args.offers)
+    history = await connection.fetch(HISTORY, root, len(subtree))
+    await connection.close()
+
+    cases = [
+        (f'/nodes ({len(subtree)} элементов)',
+         lambda: pydantic_subtree(subtree, root), lambda: serialization.subtree(subtree, root)),
+        (f'/statistic ({len(history)} записей)',
+         lambda: pydantic_statistic(history), lambda: serialization.statistic_response(history)),
+    ]
+    print(f'{"ответ":32} {"pydantic, мс":>14} {"orjson, мс":>12} {"ускорение":>10}')
+    for name, slow, fast in cases:
+        slow_time, fast_time = measure(slow, args.repeat), measure(fast, args.repeat)
+        print(f'{name:32} {slow_time * 1000:14.1f} {fast_time * 1000:12.1f} {slow_time / fast_time:9.1f}x')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
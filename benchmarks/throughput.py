@@ -0,0 +1,66 @@
+""" Пропускная способность запущенного приложения: --clients параллельных клиентов в течение --duration секунд
+запрашивают /nodes (корень и товары), /node/{id}/statistic и /sales по каталогу, созданному через /imports.
+Служит для сравнения профилей запуска, например `uvicorn main:app --reload` и `gunicorn -c gunicorn.conf.py main:app`.
+
+    python benchmarks/throughput.py [--url http://localhost:80] [--clients 16] [--duration 10]
+"""
+import argparse
+import random
+import statistics
+import threading
+from datetime import datetime
+from time import perf_counter
+from uuid import uuid4
+
+import requests
+
+
+def client(url: str, paths: list, deadline: float, seed: int, times: list):
+    session = requests.Session()
+    rnd = random.Random(seed)
+    while perf_counter() < deadline:
+        started = perf_counter()
+        response = session.get(url + rnd.choice(paths))
+        times.append(perf_counter() - started)
+        assert response.status_code == 200, response.text
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк пропускной способности')
+    parser.add_argument('--url', default='http://localhost:80')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--categories', type=int, default=10)
+    parser.add_argument('--offers', type=int, default=50, help='Товаров в каждой категории')
+    args = parser.parse_args()
+
+    root = str(uuid4())
+    categories = [str(uuid4()) for _ in range(args.categories)]
+    offers = [(str(uuid4()), category) for category in categories for _ in range(args.offers)]
+    items = [{'id': root, 'name': 'Корень', 'type': 'CATEGORY', 'parentId': None}]
+    items += [{'id': category, 'name': 'Категория', 'type': 'CATEGORY', 'parentId': root} for category in categories]
+    items += [{'id': offer, 'name': 'Товар', 'type': 'OFFER', 'parentId': category, 'price': i}
+              for i, (offer, category) in enumerate(offers)]
+    date = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    response = requests.post(f'{args.url}/imports', json={'items': items, 'updateDate': date})
+    assert response.status_code == 200, response.text
+
+    paths = [f'/nodes/{root}', f'/sales?date={date}']
+    paths += [f'/nodes/{offer}' for offer, _ in offers] + [f'/node/{offer}/statistic' for offer, _ in offers]
+    times = []
+    deadline = perf_counter() + args.duration
+    threads = [threading.Thread(target=client, args=(args.url, paths, deadline, seed, times))
+               for seed in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    requests.delete(f'{args.url}/delete/{root}')
+
+    times.sort()
+    print(f'запросов: {len(times)}, {len(times) / args.duration:.0f} в секунду')
+    print(f'p50: {statistics.median(times) * 1000:.1f} мс, p99: {times[int(len(times) * 0.99)] * 1000:.1f} мс')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import asyncio
+from collections import OrderedDict
+from typing import Union
+from uuid import UUID
+import models
+
+
+class SubtreeCache(object):
+    """ LRU-кэш сериализованных ответов /nodes, ограниченный суммарным размером в байтах.
+    Записи вычищаются по уведомлениям об измененных элементах (см. notify_items_changed):
+    поддерево устаревает, если изменился сам элемент или кто-то из его потомков, а такие
+    элементы - это он сам и его предки, которые и перечисляются в уведомлении. """
+
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = super().__new__(cls)
+        return cls.instance
+
+    def __init__(self):
+        if not hasattr(self, 'entries'):
+            self.entries: OrderedDict = OrderedDict()
+            self.max_bytes = models.EnvSettings().nodes_cache_bytes
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.invalidations = 0
+            # Увеличивается при каждом уведомлении: ответ, прочитанный до уведомления, в кэш не попадет
+            self.generation = 0
+            # Кэш работает, только пока есть LISTEN-соединение, иначе он мог бы устареть незаметно
+            self.enabled = False
+            self.connection = None
+            self.lock = asyncio.Lock()
+            # С репликой: позиция WAL основного сервера не раньше всех изменений, о которых пришли уведомления.
+            # Поддерево, прочитанное с реплики, кэшируется, только если она воспроизвела WAL до этой позиции.
+            self.track_lsn = False
+            self.lsn: Union[int, None] = None
+            self.lsn_task: Union[asyncio.Task, None] = None
+
+    def get(self, key) -> Union[bytes, None]:
+        body = self.entries.get(key) if self.enabled else None
+        if body is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def put(self, key, body: bytes, generation: int, lsn: int = None):
+        """ lsn - позиция WAL реплики, с которой прочитано поддерево; None - прочитано с основного сервера """
+        if not self.enabled or generation != self.generation or len(body) > self.max_bytes:
+            return
+        if lsn is not None and (self.lsn is None or lsn < self.lsn):
+            return
+        self.pop(key)
+        self.entries[key] = body
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def pop(self, key):
+        body = self.entries.pop(key, None)
+        if body is not None:
+            self.size -= len(body)
+
+    def invalidate(self, payload: str):
+        """ Обрабатывает уведомление items_changed: id через запятую или '*' - сбросить все """
+        self.generation += 1
+        self.invalidations += 1
+        self.update_lsn()
+        if payload == '*':
+            self.clear()
+            return
+        for key in payload.split(','):
+            self.pop(UUID(key))
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def update_lsn(self):
+        """ Запрашивает позицию WAL основного сервера; уведомления, пришедшие за время запроса, учитываются
+        следующим запросом той же задачи, так что пачка уведомлений обходится в несколько запросов """
+        if not self.track_lsn:
+            return
+        self.lsn = None
+        if self.lsn_task is None or self.lsn_task.done():
+            self.lsn_task = asyncio.ensure_future(self.fetch_lsn())
+
+    async def fetch_lsn(self):
+        while self.enabled:
+            generation = self.generation
+            try:
+                async with self.lock:
+                    lsn = await self.connection.fetchval('''SELECT (pg_current_wal_lsn() - '0/0')::bigint;''')
+            except Exception:
+                return
+            if generation == self.generation:
+                self.lsn = lsn
+                return
+
+    async def sync(self):
+        """ Дожидается уведомлений от уже зафиксированных транзакций: сервер отдает их LISTEN-соединению
+        до ответа на очередной запрос. Вызывается после записи, чтобы воркер сразу видел свои изменения. """
+        if self.enabled:
+            async with self.lock:
+                await self.connection.fetchval('''SELECT 1;''')
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
@@ -0,0 +1,111 @@
+""" Групповая запись импортов: /imports, пришедшие почти одновременно, копятся import_coalesce_ms
+и записываются одной транзакцией - с одним слиянием и одним пересчетом общих предков. """
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, NamedTuple, Set
+import asyncpg
+import models
+from database import MMDatabase
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PendingImport(NamedTuple):
+    items: List[tuple]
+    ids: Set
+    date: datetime
+    future: asyncio.Future
+
+
+class ImportCoalescer(object):
+    """ Очередь импортов воркера. Записью занимается одна задача: пока пишется группа, следующие
+    импорты копятся и уходят следующей группой. В группу попадают импорты с одной updateDate и без общих id,
+    в порядке поступления, не больше import_coalesce_max_items элементов. Если группа отклонена (ошибка
+    в одном из импортов), ее импорты записываются по отдельности, и каждый получает свой результат. """
+
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = super().__new__(cls)
+        return cls.instance
+
+    def __init__(self):
+        if not hasattr(self, 'pending'):
+            env = models.EnvSettings()
+            self.window = env.import_coalesce_ms / 1000
+            self.max_items = env.import_coalesce_max_items
+            self.pending: List[PendingImport] = []
+            self.writer: asyncio.Task = None
+            self.db = MMDatabase()
+            self.metrics = Metrics()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def insert_items(self, items: List[tuple]):
+        """ Записывает импорт в составе группы; ошибки записи этого импорта (RaiseError и др.) пробрасываются """
+        future = asyncio.get_event_loop().create_future()
+        date = items[0][2] if items else None
+        self.pending.append(PendingImport(items, {item[0] for item in items}, date, future))
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.ensure_future(self.write())
+        await future
+
+    async def write(self):
+        while self.pending:
+            await asyncio.sleep(self.window)
+            for group in self.split(self.pending):
+                del self.pending[:len(group)]
+                await self.write_group(group)
+
+    def split(self, pending: List[PendingImport]) -> List[List[PendingImport]]:
+        """ Импорты с разной updateDate пишутся разными группами: триггер ставит общим предкам одну дату
+        на группу, и запись истории для более ранней даты потерялась бы """
+        groups = []
+        group, ids, size = [], set(), 0
+        for request in pending:
+            if group and (request.date != group[0].date or not ids.isdisjoint(request.ids) or
+                          size + len(request.items) > self.max_items):
+                groups.append(group)
+                group, ids, size = [], set(), 0
+            group.append(request)
+            ids |= request.ids
+            size += len(request.items)
+        if group:
+            groups.append(group)
+        return groups
+
+    async def write_group(self, group: List[PendingImport]):
+        self.metrics.import_group.observe((), len(group))
+        if len(group) > 1:
+            try:
+                await self.db.insert_items([item for request in group for item in request.items])
+            except (asyncpg.exceptions.RaiseError, asyncpg.exceptions.ObjectInUseError):
+                logger.info('Группа из %d импортов отклонена, импорты записываются по отдельности', len(group))
+            except Exception as ex:
+                for request in group:
+                    resolve(request.future, ex)
+                return
+            else:
+                for request in group:
+                    resolve(request.future)
+                return
+        for request in group:
+            try:
+                await self.db.insert_items(request.items)
+            except Exception as ex:
+                resolve(request.future, ex)
+            else:
+                resolve(request.future)
+
+
+def resolve(future: asyncio.Future, error: Exception = None):
+    """ Отдает результат импорта, если его еще ждут (запрос мог быть прерван клиентом) """
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
@@ -1,10 +1,62 @@
-from datetime import datetime
-from typing import Union, Iterable, List
+import asyncio
+import gzip
+import hashlib
+import json
+import sys
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import Union, Iterable, List, Dict, NamedTuple, AsyncIterator, Tuple
 import asyncpg
-from asyncpg import Connection
+from asyncpg import Connection, Record
+from asyncpg.transaction import Transaction
 from asyncpg.pool import Pool
 from abc import ABCMeta, abstractmethod
+import logging
 import models
+from metrics import Metrics
+from slow_queries import SlowQueryLog
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).parent / 'migrations'
+SCHEMA_LOCK_ID = 0x4D4D5343  # advisory-блокировка, под которой воркеры по очереди обновляют схему
+HISTORY_LOCK_ID = 0x4D4D4853  # advisory-блокировка обслуживания секций истории
+IMPORT_JOBS_LOCK_ID = 0x4D4D494A  # advisory-блокировка обработчика очереди асинхронных импортов
+PURGE_LOCK_ID = 0x4D4D5055  # advisory-блокировка фоновой очистки мягко удаленных поддеревьев
+
+
+class Migration(NamedTuple):
+    """ Файл миграции вида 0001_name.sql. Миграция с первой строкой '-- no-transaction'
+    выполняется вне транзакции, по одной команде (например, для CREATE INDEX CONCURRENTLY). """
+    version: int
+    name: str
+    sql: str
+
+    @property
+    def transactional(self) -> bool:
+        return not self.sql.startswith('-- no-transaction')
+
+    def statements(self) -> List[str]:
+        """ Команды миграции без транзакции: каждая заканчивается ';' в конце строки """
+        statements, lines = [], []
+        for line in self.sql.splitlines():
+            if line.lstrip().startswith('--'):
+                continue
+            lines.append(line)
+            if line.rstrip().endswith(';'):
+                statements.append('\n'.join(lines))
+                lines = []
+        return statements
+
+
+def read_migrations() -> List[Migration]:
+    migrations = []
+    for file in sorted(MIGRATIONS_DIR.glob('*.sql')):
+        version, name = file.stem.split('_', 1)
+        migrations.append(Migration(int(version), name, file.read_text(encoding='utf-8')))
+    return migrations
 
 
 class IDatabaseCore(metaclass=ABCMeta):
@@ -12,79 +64,434 @@ class IDatabaseCore(metaclass=ABCMeta):
     async def create_pool(self):
         """ Создает пул для дальнейшей работы с БД """
 
+    @abstractmethod
+    async def close_pool(self, timeout: float = 10):
+        """ Закрывает пул, дождавшись возврата соединений """
+
     @abstractmethod
     async def execute(self, command: str, args: Iterable = tuple(),
                       fetch: bool = False,
                       fetchval: bool = False,
                       fetchrow: bool = False,
-                      execute: bool = False):
-        """ Метод для выполнения запроса к БД """
+                      execute: bool = False,
+                      executemany: bool = False,
+                      connection: Connection = None,
+                      readonly: bool = False,
+                      isolation: str = None):
+        """ Метод для выполнения запроса к БД. Если передано соединение, запрос выполняется на нем
+        в транзакции вызывающего, иначе на соединении из пула: чтение (readonly) - одной командой
+        без явной транзакции, запись - в отдельной транзакции с уровнем изоляции isolation """
+
+    @abstractmethod
+    def iterate(self, command: str, args: Iterable = tuple(), batch: int = 1000,
+                replica: bool = True) -> AsyncIterator[List[Record]]:
+        """ Выполняет запрос через серверный курсор и выдает результат пачками по batch записей;
+        replica=False - читать с основного сервера, даже если есть исправная реплика """
+
+
+def pool_max_size(env: models.EnvSettings) -> int:
+    """ Наибольший размер пула одного воркера: пулы и LISTEN-соединения кэша /nodes всех воркеров
+    вместе не должны превышать max_connections сервера за вычетом зарезервированных соединений """
+    available = (env.postgres_max_connections - env.postgres_reserved_connections) // env.web_concurrency
+    if env.nodes_cache_bytes:
+        available -= 1
+    if available < 1:
+        raise ValueError(f'{env.web_concurrency} воркерам не хватает соединений: POSTGRES_MAX_CONNECTIONS = '
+                         f'{env.postgres_max_connections}, POSTGRES_RESERVED_CONNECTIONS = '
+                         f'{env.postgres_reserved_connections}')
+    return min(env.postgres_pool_max_size, available)
+
+
+class RequestConnection(object):
+    """ Соединения из пулов на время одного HTTP-запроса: берутся при первом обращении к БД
+    (ответ из кэша обходится без них), и все следующие обращения идут через них же.
+    Чтение идет на реплику, пока она исправна, кроме запросов с read_your_writes и чтения
+    после записи в том же запросе - они должны видеть уже зафиксированные изменения. """
+
+    def __init__(self, db: 'DatabaseCore', read_your_writes: bool = False):
+        self.db = db
+        self.read_your_writes = read_your_writes
+        self.connection: Union[Connection, None] = None  # соединение с основным сервером
+        self.read_connection: Union[Connection, None] = None
+        self.replica = False  # read_connection - соединение с репликой
+        self.acquired: List[Tuple[Pool, Connection]] = []
+
+    async def get(self) -> Connection:
+        """ Соединение с основным сервером """
+        if self.connection is None:
+            pool, self.connection = await self.db.acquire_connection()
+            self.acquired.append((pool, self.connection))
+        return self.connection
+
+    async def read(self) -> Connection:
+        """ Соединение для чтения: с репликой либо с основным сервером """
+        if self.connection is not None or self.read_your_writes:
+            return await self.get()
+        if self.read_connection is None:
+            pool, self.read_connection = await self.db.acquire_connection(readonly=True)
+            self.acquired.append((pool, self.read_connection))
+            self.replica = pool is not self.db.pool
+            if not self.replica:
+                self.connection = self.read_connection
+        return self.read_connection
+
+    async def release(self):
+        for pool, connection in self.acquired:
+            await pool.release(connection)
+        self.acquired.clear()
+        self.connection = self.read_connection = None
 
 
 class DatabaseCore(IDatabaseCore):
+    # Именованные запросы горячих путей: имя - метка в метриках; планы хранит кэш выражений asyncpg
+    statements: Dict[str, str] = dict()
+
     def __init__(self):
         if not hasattr(self, 'pool'):
             self.pool: Union[Pool, None] = None
+            # Пул реплики для чтения; пока проверка не подтвердила, что она доступна и не отстает, не используется
+            self.replica: Union[Pool, None] = None
+            self.replica_healthy = False
+            self.replica_lag: Union[float, None] = None
+            self.waiting = 0  # вызовов, ожидающих соединение из пула
+            # текст запроса -> метка в метриках: имя из statements либо метода, вызвавшего execute
+            self.statement_names: Dict[str, str] = {command: name for name, command in self.statements.items()}
+            self.metrics = Metrics()
+            self.slow_queries = SlowQueryLog()
 
     async def create_pool(self):
         env = models.EnvSettings()
-        self.pool = await asyncpg.create_pool(host=env.postgres_host, port=env.postgres_port, user=env.postgres_user, password=env.postgres_password, database=env.postgres_db)
+        max_size = pool_max_size(env)
+        logger.info('Пул соединений воркера: до %d из %d соединений сервера на %d воркеров',
+                    max_size, env.postgres_max_connections, env.web_concurrency)
+        self.pool = await self.connect_pool(env, env.postgres_host, env.postgres_port, env.postgres_db,
+                                            min(env.postgres_pool_min_size, max_size), max_size)
+        if env.postgres_replica_host is not None:
+            # Соединения с репликой открываются по мере надобности: недоступная реплика не мешает запуску
+            self.replica = await self.connect_pool(env, env.postgres_replica_host,
+                                                   env.postgres_replica_port or env.postgres_port,
+                                                   env.postgres_replica_db or env.postgres_db, 0, max_size)
+
+    async def connect_pool(self, env: models.EnvSettings, host: str, port: int, database: str,
+                           min_size: int, max_size: int) -> Pool:
+        return await asyncpg.create_pool(host=host, port=port, user=env.postgres_user, password=env.postgres_password, database=database,
+                                         min_size=min_size,
+                                         max_size=max_size,
+                                         max_inactive_connection_lifetime=env.postgres_max_inactive_connection_lifetime,
+                                         statement_cache_size=env.postgres_statement_cache_size,
+                                         command_timeout=env.postgres_command_timeout,
+                                         server_settings={'application_name': env.postgres_application_name})
+
+    @asynccontextmanager
+    async def acquire(self, readonly: bool = False) -> AsyncIterator[Connection]:
+        """ Соединение из пула на время блока with """
+        pool, connection = await self.acquire_connection(readonly)
+        try:
+            yield connection
+        finally:
+            await pool.release(connection)
+
+    async def acquire_connection(self, readonly: bool = False) -> Tuple[Pool, Connection]:
+        """ Берет соединение из пула: для чтения - из пула реплики, пока она исправна, иначе из основного.
+        Пока свободного соединения нет, вызов учитывается в метрике ожидающих. Возвращает и пул,
+        в который соединение нужно вернуть. """
+        pool = self.replica if readonly and self.replica_healthy else self.pool
+        self.waiting += 1
+        try:
+            if pool is not self.pool:
+                try:
+                    return pool, await pool.acquire()
+                except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as ex:
+                    self.set_replica_health(False, None, ex)
+                    pool = self.pool
+            return pool, await pool.acquire()
+        finally:
+            self.waiting -= 1
+
+    async def check_replica(self):
+        """ Проверяет, что реплика отвечает и отстает не больше postgres_replica_max_lag секунд.
+        Реплика, которая догнала основной сервер, не отстает, даже если записей давно не было. """
+        command = '''
+        SELECT CASE 
+            WHEN NOT pg_is_in_recovery() THEN 0 
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 'infinity') 
+        END::float8;
+        '''
+        env = models.EnvSettings()
+        try:
+            async with self.replica.acquire() as connection:
+                lag = await connection.fetchval(command, timeout=env.postgres_replica_check_interval + 5)
+        except Exception as ex:
+            self.set_replica_health(False, None, ex)
+            return
+        self.set_replica_health(lag <= env.postgres_replica_max_lag, lag)
+
+    def set_replica_health(self, healthy: bool, lag: Union[float, None], error: Exception = None):
+        if healthy != self.replica_healthy:
+            if healthy:
+                logger.info('Чтение переключено на реплику, отставание %.3f с', lag)
+            elif error is not None:
+                logger.warning('Реплика недоступна, чтение переключено на основной сервер: %r', error)
+            else:
+                logger.warning('Реплика отстает на %.3f с, чтение переключено на основной сервер', lag)
+        self.replica_healthy = healthy
+        self.replica_lag = lag
+
+    async def close_pool(self, timeout: float = 10):
+        """ Дожидается, пока запросы вернут соединения в пул, и закрывает их; по истечении timeout - принудительно """
+        for pool in (self.pool, self.replica):
+            if pool is None:
+                continue
+            try:
+                await asyncio.wait_for(pool.close(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning('Соединения не вернулись в пул за %s с, пул закрыт принудительно', timeout)
+                pool.terminate()
+
+    def transaction(self, connection: Connection, isolation: str = None) -> Transaction:
+        """ Транзакция записи; уровень изоляции по умолчанию - из настроек """
+        return connection.transaction(isolation=isolation or models.EnvSettings().postgres_write_isolation)
 
     async def execute(self, command: str, args=tuple(),
                       fetch: bool = False,
                       fetchval: bool = False,
                       fetchrow: bool = False,
                       execute: bool = False,
-                      executemany: bool = False):
+                      executemany: bool = False,
+                      connection: Connection = None,
+                      readonly: bool = False,
+                      isolation: str = None):
+        statement = self.statement_names.get(command)
+        if statement is None:
+            statement = self.statement_names[command] = sys._getframe(1).f_code.co_name
+        if connection is None:
+            async with self.acquire(readonly) as connection:
+                if readonly:
+                    return await self.execute(command, args, fetch, fetchval, fetchrow, execute, executemany,
+                                              connection, readonly)
+                async with self.transaction(connection, isolation):
+                    return await self.execute(command, args, fetch, fetchval, fetchrow, execute, executemany,
+                                              connection, readonly)
+        started = perf_counter()
         result = None
-        async with self.pool.acquire() as connection:
-            connection: Connection
-            async with connection.transaction():
-                if fetch:
-                    result = await connection.fetch(command, *args)
-                elif fetchval:
-                    result = await connection.fetchval(command, *args)
-                elif fetchrow:
-                    result = await connection.fetchrow(command, *args)
-                elif execute:
-                    result = await connection.execute(command, *args)
-                elif executemany:
-                    result = await connection.executemany(command, args)
+        if fetch:
+            result = await connection.fetch(command, *args)
+        elif fetchval:
+            result = await connection.fetchval(command, *args)
+        elif fetchrow:
+            result = await connection.fetchrow(command, *args)
+        elif execute:
+            result = await connection.execute(command, *args)
+        elif executemany:
+            result = await connection.executemany(command, args)
+        elapsed = perf_counter() - started
+        self.metrics.observe_statement(statement, elapsed)
+        if self.slow_queries.threshold is not None and elapsed >= self.slow_queries.threshold:
+            entry = self.slow_queries.add(statement, command, args, elapsed, executemany)
+            if not executemany and self.slow_queries.should_explain(command):
+                asyncio.ensure_future(self.explain(entry, command, args, analyze=readonly))
         return result
 
+    async def explain(self, entry: dict, command: str, args=tuple(), analyze: bool = False):
+        """ Сохраняет в запись журнала медленных запросов план запроса. EXPLAIN ANALYZE выполняет запрос
+        заново, поэтому делается только для чтения; для записи сохраняется план без выполнения.
+        Транзакция в любом случае откатывается. """
+        self.slow_queries.explaining = True
+        options = '(ANALYZE, BUFFERS)' if analyze else ''
+        try:
+            async with self.acquire(readonly=analyze) as connection:
+                connection: Connection
+                transaction = connection.transaction()
+                await transaction.start()
+                try:
+                    records = await connection.fetch(f'EXPLAIN {options} {command}', *args,
+                                                     timeout=self.slow_queries.explain_timeout)
+                finally:
+                    await transaction.rollback()
+            entry['plan'] = '\n'.join(record[0] for record in records)
+        except Exception as ex:
+            logger.warning('Не удалось получить план запроса %s: %r', entry['statement'], ex)
+        finally:
+            self.slow_queries.explaining = False
+
+    async def iterate(self, command: str, args=tuple(), batch: int = 1000,
+                      replica: bool = True) -> AsyncIterator[List[Record]]:
+        statement = self.statement_names.get(command, 'iterate')
+        async with self.acquire(readonly=replica) as connection:
+            connection: Connection
+            async with connection.transaction(readonly=True):
+                started = perf_counter()
+                cursor = await connection.cursor(command, *args)
+                self.metrics.observe_statement(statement, perf_counter() - started)
+                while True:
+                    started = perf_counter()
+                    records = await cursor.fetch(batch)
+                    self.metrics.observe_statement(statement, perf_counter() - started)
+                    if not records:
+                        break
+                    yield records
+
 
 class MMDatabase(DatabaseCore):
+    # Запросы горячих путей; после первого выполнения на соединении берутся из кэша выражений asyncpg
+    statements = {
+        'get_subtree': '''
+        SELECT id, name, date, "parentId", type, price FROM items 
+        WHERE path @> ARRAY[$1::uuid] AND NOT path && ARRAY(SELECT id FROM tombstones);
+        ''',
+        'get_last_24h': '''
+        SELECT item_id as id, item_name as name, "item_parentId" as "parentId", item_type as type, item_price as price, item_date as date  
+        FROM items_history WHERE item_type = 'OFFER' AND item_date <= $1 AND item_date >= $1 - INTERVAL '24 hour' AND 
+            item_id NOT IN (SELECT id FROM items WHERE path && ARRAY(SELECT id FROM tombstones));
+        ''',
+        'get_statistics': '''
+        SELECT history.* FROM items LEFT JOIN LATERAL (
+            SELECT item_id as id, item_name as name, "item_parentId" as "parentId", item_type as type, item_price as price, item_date as date, 
+                id as history_id 
+            FROM items_history 
+            WHERE 
+                item_id = $1 AND
+                item_date >= COALESCE($2, '-infinity'::timestamptz) AND
+                item_date < COALESCE($3, 'infinity'::timestamptz) AND 
+                (item_date, id) > (COALESCE($4, '-infinity'::timestamptz), COALESCE($5, 0)) 
+            ORDER BY item_date, id 
+            LIMIT $6
+        ) AS history ON true 
+        WHERE items.id = $1 AND NOT items.path && ARRAY(SELECT id FROM tombstones) 
+        ORDER BY history.date, history.history_id;
+        ''',
+        'get_statistics_buckets': '''
+        SELECT buckets.* FROM items LEFT JOIN LATERAL (
+            SELECT date_trunc($4, item_date, 'UTC') as date, 
+                (array_agg(item_price ORDER BY item_date, id))[1] as open, 
+                MIN(item_price) as min, 
+                MAX(item_price) as max, 
+                (array_agg(item_price ORDER BY item_date DESC, id DESC))[1] as last 
+            FROM items_history 
+            WHERE 
+                item_id = $1 AND
+                item_date >= COALESCE($2, '-infinity'::timestamptz) AND
+                item_date < COALESCE($3, 'infinity'::timestamptz) 
+            GROUP BY 1
+        ) AS buckets ON true 
+        WHERE items.id = $1 AND NOT items.path && ARRAY(SELECT id FROM tombstones) 
+        ORDER BY buckets.date;
+        ''',
+        'lock_item': '''
+        WITH target AS (
+            SELECT path, COALESCE(type = 'CATEGORY' AND offer_count >= $2, false) AS soft FROM items WHERE id = $1
+        ) 
+        SELECT target.soft FROM items, target 
+        WHERE (items.id = ANY(target.path) OR items.path && CASE WHEN target.soft THEN '{}' ELSE ARRAY[$1::uuid] END) AND 
+            NOT items.path && ARRAY(SELECT id FROM tombstones) 
+        ORDER BY items.id 
+        FOR UPDATE OF items;
+        ''',
+        'delete_item': '''
+        WITH deleted AS (
+            DELETE FROM items WHERE path @> ARRAY[$1::uuid] AND NOT path && ARRAY(SELECT id FROM tombstones) RETURNING 1
+        ) 
+        SELECT count(*) FROM deleted;
+        ''',
+    }
+
     def __new__(cls):
         if not hasattr(cls, 'instance'):
             cls.instance = super().__new__(cls)
         return cls.instance
 
     async def db_init(self):
-        await self.create_extension_uuid_ossp()
-        await self.create_enum_type()
-        await self.create_main_table()
-        await self.create_history_table()
-
-        await self.create_function_history()
-        await self.create_function_update_cat()
-        await self.create_function_insert_in_cat()
-        await self.create_function_delete_from_cat()
-        await self.create_function_delete_cat()
-        await self.create_function_get_avg_price()
-        await self.create_function_check_errors()
-
-        await self.create_trigger_history()
-        await self.create_trigger_update_cat()
-        await self.create_trigger_insert_in_cat()
-        await self.create_trigger_delete_from_cat()
-        await self.create_trigger_delete_cat()
-        await self.create_trigger_check_errors()
-
-    async def create_extension_uuid_ossp(self):
+        """ Приводит схему БД к версии кода. Воркеры делают это по очереди под advisory-блокировкой;
+        если сохраненный отпечаток схемы совпадает с текущим, DDL не выполняется.
+
+        Таблицы, миграции, функции с триггерами и отпечаток пишутся одной транзакцией: ошибка на любом шаге
+        откатывает все, и следующий старт начинает с той же схемы. Исключение - миграции вне транзакции:
+        CREATE INDEX CONCURRENTLY нельзя выполнить в транзакции, а таблицы предыдущих миграций к нему уже
+        должны быть зафиксированы. Перед такой миграцией транзакция фиксируется, а после нее открывается новая:
+        следующие миграции могут зависеть от ее индексов, поэтому порядок миграций сохраняется. """
+        fingerprint = schema_fingerprint()
+        async with self.acquire() as connection:
+            connection: Connection
+            await self.lock_schema(connection)
+            try:
+                if await self.get_schema_fingerprint(connection) == fingerprint:
+                    return
+                started = perf_counter()
+                transaction = connection.transaction()
+                await transaction.start()
+                try:
+                    await self.create_tables(connection)
+                    applied = []
+                    for migration in await self.pending_migrations(connection):
+                        if not migration.transactional:
+                            await transaction.commit()
+                            transaction = None
+                            await self.apply_migration(connection, migration)
+                            transaction = connection.transaction()
+                            await transaction.start()
+                        else:
+                            await self.apply_migration(connection, migration)
+                        applied.append(migration.version)
+                    await self.create_schema(connection, applied)
+                    await self.set_schema_fingerprint(connection, fingerprint)
+                except BaseException:
+                    if transaction is not None:
+                        await transaction.rollback()
+                    raise
+                await transaction.commit()
+                logger.info('Схема БД обновлена за %.3f с', perf_counter() - started)
+            finally:
+                await self.unlock_schema(connection)
+
+    async def create_tables(self, connection: Connection):
+        """ Исходные таблицы, которые дальше развиваются миграциями """
+        await self.create_extension_uuid_ossp(connection)
+        await self.create_enum_type(connection)
+        await self.create_main_table(connection)
+        await self.create_history_table(connection)
+        await self.create_migrations_table(connection)
+        await self.create_fingerprint_table(connection)
+
+    async def create_schema(self, connection: Connection, applied: List[int]):
+        """ Функции и триггеры поверх таблиц после миграций; выполняется в транзакции db_init.
+        Колонки, добавленные примененными сейчас миграциями, заполняются уже созданными функциями. """
+        await self.create_function_history(connection)
+        await self.create_function_notify_items_changed(connection)
+        await self.create_function_create_history_partition(connection)
+        await self.create_function_create_history_partitions(connection)
+        await self.create_function_get_avg_price(connection)
+        await self.create_function_refresh_paths(connection)
+        await self.create_function_check_paths(connection)
+        await self.create_function_rebuild_paths(connection)
+        await self.create_function_update_ancestors(connection)
+        await self.create_function_check_aggregates(connection)
+        await self.create_function_rebuild_aggregates(connection)
+        await self.create_function_update_cat(connection)
+        await self.create_function_insert_in_cat(connection)
+        await self.create_function_delete_from_cat(connection)
+        await self.create_function_soft_delete_item(connection)
+        await self.create_function_purge_deleted(connection)
+        await self.create_function_reclaim_deleted(connection)
+        await self.create_function_check_errors(connection)
+
+        await self.create_trigger_update_cat(connection)
+        await self.create_trigger_insert_in_cat(connection)
+        await self.create_trigger_delete_from_cat(connection)
+        await self.create_trigger_check_errors(connection)
+
+        if 3 in applied:
+            await self.rebuild_paths(connection)
+        if 2 in applied:
+            await self.rebuild_aggregates(connection)
+        if 5 in applied:
+            await self.create_history_partitions(models.EnvSettings().history_partitions_ahead, connection)
+
+    async def create_extension_uuid_ossp(self, connection: Connection):
         command = '''CREATE EXTENSION IF NOT EXISTS "uuid-ossp"'''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_enum_type(self):
+    async def create_enum_type(self, connection: Connection):
         command = '''
         DO
         $$
@@ -95,9 +502,9 @@ class MMDatabase(DatabaseCore):
         END;
         $$
         LANGUAGE plpgsql;'''
-        await self.execute(command, fetch=True)
+        await self.execute(command, fetch=True, connection=connection)
 
-    async def create_main_table(self):
+    async def create_main_table(self, connection: Connection):
         command = '''
         CREATE TABLE IF NOT EXISTS items (
             id uuid DEFAULT uuid_generate_v4(),
@@ -109,9 +516,9 @@ class MMDatabase(DatabaseCore):
             PRIMARY KEY (id)
         );
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_history_table(self):
+    async def create_history_table(self, connection: Connection):
         command = '''
                 CREATE TABLE IF NOT EXISTS items_history (
                     id SERIAL,
@@ -124,190 +531,659 @@ class MMDatabase(DatabaseCore):
                     PRIMARY KEY (id)
                 );
                 '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_trigger_history(self):
+    async def create_migrations_table(self, connection: Connection):
         command = '''
-        CREATE OR REPLACE TRIGGER write_to_history_trigger 
-        AFTER INSERT OR UPDATE ON items 
-        FOR EACH ROW 
-        EXECUTE FUNCTION write_to_history();
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT,
+            name VARCHAR (255) NOT NULL,
+            applied_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+            PRIMARY KEY (version)
+        );
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_function_history(self):
+    async def create_fingerprint_table(self, connection: Connection):
         command = '''
-        CREATE OR REPLACE FUNCTION write_to_history() 
-        RETURNS trigger AS 
-        $$
-        BEGIN
-            IF EXISTS (SELECT 1 FROM items_history WHERE item_id = NEW.id AND item_date = NEW.date) THEN 
-                UPDATE items_history 
-                SET (item_name, "item_parentId", item_type, item_price) = (NEW.name, NEW."parentId", NEW.type, NEW.price) 
-                WHERE item_id = NEW.id AND item_date = NEW.date;
-            ELSE  
-                INSERT INTO items_history (item_id, item_name, item_date, "item_parentId", item_type, item_price) 
-                VALUES (NEW.id, NEW.name, NEW.date, NEW."parentId", NEW.type, NEW.price);
-            END IF;
-            RETURN NEW;
-        END;
-        $$
-        LANGUAGE 'plpgsql';
+        CREATE TABLE IF NOT EXISTS schema_fingerprint (
+            id BOOLEAN DEFAULT TRUE CHECK (id),
+            fingerprint VARCHAR (64) NOT NULL,
+            applied_at TIMESTAMP with time zone NOT NULL DEFAULT now(),
+            PRIMARY KEY (id)
+        );
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def lock_schema(self, connection: Connection):
+        """ Захватывает сессионную advisory-блокировку схемы. Ожидание идет опросом, а не в запросе:
+        иначе ожидающий воркер блокировал бы CREATE INDEX CONCURRENTLY владельца блокировки. """
+        while not await connection.fetchval('''SELECT pg_try_advisory_lock($1);''', SCHEMA_LOCK_ID):
+            await asyncio.sleep(0.01)
+
+    async def unlock_schema(self, connection: Connection):
+        await connection.execute('''SELECT pg_advisory_unlock($1);''', SCHEMA_LOCK_ID)
+
+    async def get_schema_fingerprint(self, connection: Connection):
+        command = '''SELECT to_regclass('schema_fingerprint') IS NOT NULL;'''
+        if not await self.execute(command, fetchval=True, connection=connection):
+            return None
+        command = '''SELECT fingerprint FROM schema_fingerprint;'''
+        return await self.execute(command, fetchval=True, connection=connection)
+
+    async def set_schema_fingerprint(self, connection: Connection, fingerprint: str):
+        command = '''
+        INSERT INTO schema_fingerprint (fingerprint) VALUES ($1) 
+        ON CONFLICT (id) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, applied_at = now();
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, (fingerprint, ), execute=True, connection=connection)
+
+    async def get_applied_migrations(self, connection: Connection = None):
+        command = '''SELECT version FROM schema_migrations;'''
+        records = await self.execute(command, fetch=True, connection=connection, readonly=True)
+        return {record['version'] for record in records}
+
+    async def pending_migrations(self, connection: Connection) -> List[Migration]:
+        """ Еще не примененные миграции из каталога migrations в порядке номеров """
+        done = await self.get_applied_migrations(connection)
+        return [migration for migration in read_migrations() if migration.version not in done]
 
-    async def create_trigger_update_cat(self):
+    async def apply_migration(self, connection: Connection, migration: Migration):
+        """ Выполняет миграцию и отмечает ее примененной. Транзакционная миграция выполняется
+        в транзакции вызывающего (db_init), миграция вне транзакции - по одной команде. """
+        started = perf_counter()
+        if migration.transactional:
+            await connection.execute(migration.sql)
+        else:
+            # CONCURRENTLY не работает внутри транзакции, поэтому команды выполняются по одной
+            for statement in migration.statements():
+                await connection.execute(statement)
+        await self.add_applied_migration(connection, migration)
+        logger.info('Миграция %04d_%s применена за %.3f с', migration.version, migration.name,
+                    perf_counter() - started)
+
+    async def add_applied_migration(self, connection: Connection, migration: Migration):
+        command = '''INSERT INTO schema_migrations (version, name) VALUES ($1, $2);'''
+        await self.execute(command, (migration.version, migration.name), execute=True, connection=connection)
+
+    async def create_trigger_update_cat(self, connection: Connection):
         command = '''
         CREATE OR REPLACE TRIGGER update_cat 
         AFTER UPDATE ON items 
-        FOR EACH ROW 
+        REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items 
+        FOR EACH STATEMENT 
         EXECUTE FUNCTION update_cat_func();
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_trigger_insert_in_cat(self):
+    async def create_trigger_insert_in_cat(self, connection: Connection):
         command = '''
         CREATE OR REPLACE TRIGGER insert_in_cat 
         AFTER INSERT ON items 
-        FOR EACH ROW 
+        REFERENCING NEW TABLE AS new_items 
+        FOR EACH STATEMENT 
         EXECUTE FUNCTION insert_in_cat_func();
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_trigger_delete_from_cat(self):
+    async def create_trigger_delete_from_cat(self, connection: Connection):
         command = '''
         CREATE OR REPLACE TRIGGER delete_from_cat 
         AFTER DELETE ON items 
-        FOR EACH ROW 
+        REFERENCING OLD TABLE AS old_items 
+        FOR EACH STATEMENT 
         EXECUTE FUNCTION delete_from_cat_func();
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_trigger_delete_cat(self):
-        command = '''
-        CREATE OR REPLACE TRIGGER delete_cat 
-        AFTER DELETE ON items 
-        FOR EACH ROW 
-        EXECUTE FUNCTION delete_cat_func();
-        '''
-        await self.execute(command, execute=True)
-
-    async def create_trigger_check_errors(self):
+    async def create_trigger_check_errors(self, connection: Connection):
         command = '''
                 CREATE OR REPLACE TRIGGER check_errors  
                 BEFORE INSERT OR UPDATE ON items 
                 FOR EACH ROW 
                 EXECUTE FUNCTION check_errors_func();
                 '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_function_update_cat(self):
+    async def create_function_history(self, connection: Connection):
         command = '''
-        CREATE OR REPLACE FUNCTION update_cat_func() 
-        RETURNS trigger AS 
+        CREATE OR REPLACE FUNCTION write_to_history(ids uuid[]) 
+        RETURNS void AS 
+        $$
+        BEGIN
+            INSERT INTO items_history (item_id, item_name, item_date, "item_parentId", item_type, item_price) 
+            SELECT id, name, date, "parentId", type, price FROM items WHERE id = ANY(ids) 
+            ON CONFLICT (item_id, item_date) DO UPDATE 
+            SET (item_name, "item_parentId", item_type, item_price) = 
+                (EXCLUDED.item_name, EXCLUDED."item_parentId", EXCLUDED.item_type, EXCLUDED.item_price);
+        END;
+        $$
+        LANGUAGE 'plpgsql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_notify_items_changed(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION notify_items_changed(ids uuid[]) 
+        RETURNS void AS 
         $$
+        DECLARE 
+            payload text;
         BEGIN
-            IF (NEW.type = 'CATEGORY') AND (NEW.price IS NULL) AND (OLD.price IS NOT NULL) AND (EXISTS (SELECT 1 FROM items WHERE "parentId" = NEW.id)) THEN
-                UPDATE items SET price = OLD.price WHERE id = NEW.id;
+            -- id через запятую, не больше 200 в уведомлении (лимит 8000 байт); 
+            -- при массовых изменениях дешевле сбросить кэш целиком
+            IF cardinality(ids) > 2000 THEN
+                PERFORM pg_notify('items_changed', '*');
+                RETURN;
             END IF;
-            
-            IF NEW."parentId" = OLD."parentId" THEN
-                UPDATE items SET date = NEW.date WHERE id = OLD."parentId";
-                IF OLD.price = NEW.price THEN
-                    RETURN NEW;
-                END IF;
-                UPDATE items SET price = (SELECT * FROM get_avg_price(OLD."parentId")) WHERE id = OLD."parentId";
-            ELSE 
-                IF OLD."parentId" IS NOT NULL THEN
-                    UPDATE items SET date = NEW.date WHERE id = OLD."parentId";
-                    UPDATE items SET price = (SELECT * FROM get_avg_price(OLD."parentId")) WHERE id = OLD."parentId";
-                END IF;
-                IF NEW."parentId" IS NOT NULL THEN
-                    UPDATE items SET date = NEW.date WHERE id = NEW."parentId";
-                    UPDATE items SET price = (SELECT * FROM get_avg_price(NEW."parentId")) WHERE id = NEW."parentId";
+            FOR payload IN 
+                SELECT string_agg(id::text, ',') FROM (
+                    SELECT id, (row_number() OVER () - 1) / 200 AS chunk FROM (SELECT DISTINCT unnest(ids) AS id) AS u
+                ) AS numbered 
+                GROUP BY chunk
+            LOOP
+                PERFORM pg_notify('items_changed', payload);
+            END LOOP;
+        END;
+        $$
+        LANGUAGE 'plpgsql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_create_history_partition(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION create_history_partition(month date) 
+        RETURNS void AS 
+        $$
+        DECLARE 
+            partition text := format('items_history_%s', to_char(month, 'YYYY_MM'));
+            lower_bound TIMESTAMP with time zone := month::timestamp AT TIME ZONE 'UTC';
+            upper_bound TIMESTAMP with time zone := (month + interval '1 month') AT TIME ZONE 'UTC';
+        BEGIN
+            EXECUTE format('CREATE TABLE %I (LIKE items_history INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition);
+            -- строки этого месяца, попавшие раньше в секцию по умолчанию, переносятся в новую секцию
+            EXECUTE format('WITH moved AS (DELETE FROM items_history_default 
+                                           WHERE item_date >= $1 AND item_date < $2 RETURNING *) 
+                            INSERT INTO %I SELECT * FROM moved', partition) 
+                USING lower_bound, upper_bound;
+            EXECUTE format('ALTER TABLE items_history ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', 
+                           partition, lower_bound, upper_bound);
+        END;
+        $$
+        LANGUAGE 'plpgsql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_create_history_partitions(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION create_history_partitions(months_ahead integer) 
+        RETURNS integer AS 
+        $$
+        DECLARE 
+            month date;
+            created integer := 0;
+        BEGIN
+            FOR month IN 
+                SELECT generate_series(date_trunc('month', now() AT TIME ZONE 'UTC'), 
+                                       date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => months_ahead), 
+                                       interval '1 month')::date 
+                UNION 
+                SELECT DISTINCT date_trunc('month', item_date AT TIME ZONE 'UTC')::date FROM items_history_default 
+                ORDER BY 1
+            LOOP
+                IF to_regclass(format('items_history_%s', to_char(month, 'YYYY_MM'))) IS NULL THEN
+                    PERFORM create_history_partition(month);
+                    created := created + 1;
                 END IF;
+            END LOOP;
+            RETURN created;
+        END;
+        $$
+        LANGUAGE 'plpgsql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_refresh_paths(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION refresh_paths(roots uuid[]) 
+        RETURNS void AS 
+        $$
+        DECLARE 
+            reached integer;
+            hidden uuid[];
+        BEGIN
+            IF cardinality(roots) = 0 THEN
+                RETURN;
+            END IF;
+            -- пути строк мягко удаленных поддеревьев не меняются: они ждут фоновой очистки
+            hidden := ARRAY(SELECT id FROM tombstones);
+            WITH RECURSIVE tops AS (
+                SELECT items.id, items.type, COALESCE(parent.path, '{}') || items.id AS path 
+                FROM items LEFT JOIN items AS parent ON parent.id = items."parentId" AND parent.type = 'CATEGORY' 
+                WHERE items.id = ANY(roots) AND 
+                    (parent.id IS NULL OR NOT (parent.id = ANY(roots) OR parent.path && roots))
+            ), 
+            moved AS (
+                SELECT id, type, path FROM tops
+            UNION ALL
+                SELECT items.id, items.type, moved.path || items.id FROM items JOIN moved ON items."parentId" = moved.id 
+                WHERE moved.type = 'CATEGORY' AND NOT items.path && hidden
+            ), 
+            updated AS (
+                UPDATE items SET path = moved.path FROM moved 
+                WHERE items.id = moved.id AND items.path IS DISTINCT FROM moved.path
+            ) 
+            SELECT count(*) INTO reached FROM moved WHERE id = ANY(roots);
+            
+            IF reached < cardinality(roots) THEN
+                RAISE EXCEPTION 'Категория не может быть вложена в собственную подкатегорию!';
             END IF;
-            RETURN NEW;
         END;
         $$
         LANGUAGE 'plpgsql';
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_function_insert_in_cat(self):
+    async def create_function_check_paths(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION check_paths() 
+        RETURNS TABLE (id uuid, path uuid[], expected_path uuid[]) AS 
+        $$
+            WITH RECURSIVE expected AS (
+                SELECT items.id, items.type, ARRAY[items.id] AS path FROM items 
+                WHERE items."parentId" IS NULL OR NOT EXISTS (
+                    SELECT 1 FROM items AS parent WHERE parent.id = items."parentId" AND parent.type = 'CATEGORY')
+            UNION ALL
+                SELECT items.id, items.type, expected.path || items.id FROM items JOIN expected ON items."parentId" = expected.id 
+                WHERE expected.type = 'CATEGORY'
+            ) 
+            SELECT items.id, items.path, expected.path FROM items LEFT JOIN expected ON expected.id = items.id 
+            WHERE items.path IS DISTINCT FROM expected.path AND NOT items.path && ARRAY(SELECT id FROM tombstones);
+        $$
+        LANGUAGE 'sql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_rebuild_paths(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION rebuild_paths() 
+        RETURNS integer AS 
+        $$
+        DECLARE 
+            fixed integer;
+        BEGIN
+            PERFORM set_config('mm.skip_cascade', 'on', true);
+            UPDATE items SET path = wrong.expected_path 
+            FROM check_paths() AS wrong 
+            WHERE items.id = wrong.id AND wrong.expected_path IS NOT NULL;
+            GET DIAGNOSTICS fixed = ROW_COUNT;
+            PERFORM set_config('mm.skip_cascade', 'off', true);
+            RETURN fixed;
+        END;
+        $$
+        LANGUAGE 'plpgsql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_update_ancestors(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION update_ancestors(changed uuid[], parents uuid[], new_date TIMESTAMP with time zone, 
+                                                    delta_ids uuid[], delta_sums bigint[], delta_counts bigint[]) 
+        RETURNS void AS 
+        $$
+        DECLARE 
+            ancestors uuid[];
+        BEGIN
+            ancestors := ARRAY(SELECT DISTINCT unnest(path) FROM items WHERE id = ANY(parents));
+            
+            WITH deltas AS (
+                SELECT id, SUM(s) AS s, SUM(c) AS c FROM unnest(delta_ids, delta_sums, delta_counts) AS d(id, s, c) 
+                WHERE id IS NOT NULL GROUP BY id
+            ), 
+            chain AS (
+                SELECT unnest(items.path) AS id, deltas.s, deltas.c FROM deltas JOIN items ON items.id = deltas.id
+            ), 
+            totals AS (
+                SELECT a.id, COALESCE(SUM(chain.s), 0)::bigint AS s, COALESCE(SUM(chain.c), 0)::bigint AS c 
+                FROM unnest(ancestors) AS a(id) LEFT JOIN chain ON chain.id = a.id 
+                GROUP BY a.id
+            ) 
+            UPDATE items SET 
+                date = COALESCE(new_date, items.date), 
+                offer_sum = items.offer_sum + totals.s, 
+                offer_count = items.offer_count + totals.c, 
+                price = CASE WHEN items.offer_count + totals.c > 0 
+                        THEN (items.offer_sum + totals.s) / (items.offer_count + totals.c) END 
+            FROM totals 
+            WHERE items.id = totals.id AND items.type = 'CATEGORY';
+            
+            UPDATE items SET price = CASE WHEN offer_count > 0 THEN offer_sum / offer_count END 
+            WHERE id = ANY(changed) AND type = 'CATEGORY' AND NOT id = ANY(ancestors);
+            
+            PERFORM write_to_history(ancestors || changed);
+            PERFORM notify_items_changed(ancestors || changed);
+        END;
+        $$
+        LANGUAGE 'plpgsql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_check_aggregates(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION check_aggregates() 
+        RETURNS TABLE (id uuid, offer_sum bigint, offer_count int, price int, 
+                       expected_sum bigint, expected_count int, expected_price int) AS 
+        $$
+            WITH RECURSIVE up AS (
+                SELECT "parentId" AS id, price::bigint AS price FROM items 
+                WHERE type = 'OFFER' AND NOT path && ARRAY(SELECT id FROM tombstones) AND 
+                    EXISTS (SELECT 1 FROM items AS parent WHERE parent.id = items."parentId" AND parent.type = 'CATEGORY')
+            UNION ALL
+                SELECT items."parentId", up.price FROM items JOIN up ON items.id = up.id 
+                WHERE items."parentId" IS NOT NULL
+            ), 
+            expected AS (
+                SELECT items.id, items.offer_sum, items.offer_count, items.price, 
+                    COALESCE(SUM(up.price), 0)::bigint AS expected_sum, COUNT(up.price)::int AS expected_count, 
+                    get_avg_price(items.id) AS expected_price 
+                FROM items LEFT JOIN up ON up.id = items.id 
+                WHERE items.type = 'CATEGORY' AND NOT items.path && ARRAY(SELECT id FROM tombstones) 
+                GROUP BY items.id
+            ) 
+            SELECT * FROM expected 
+            WHERE (offer_sum, offer_count) != (expected_sum, expected_count) OR price IS DISTINCT FROM expected_price;
+        $$
+        LANGUAGE 'sql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_rebuild_aggregates(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION rebuild_aggregates() 
+        RETURNS integer AS 
+        $$
+        DECLARE 
+            fixed integer;
+        BEGIN
+            PERFORM set_config('mm.skip_cascade', 'on', true);
+            UPDATE items SET 
+                offer_sum = wrong.expected_sum, 
+                offer_count = wrong.expected_count, 
+                price = CASE WHEN wrong.expected_count > 0 THEN wrong.expected_sum / wrong.expected_count END 
+            FROM check_aggregates() AS wrong 
+            WHERE items.id = wrong.id;
+            GET DIAGNOSTICS fixed = ROW_COUNT;
+            PERFORM set_config('mm.skip_cascade', 'off', true);
+            RETURN fixed;
+        END;
+        $$
+        LANGUAGE 'plpgsql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_update_cat(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION update_cat_func() 
+        RETURNS trigger AS 
+        $$
+        DECLARE 
+            delta_ids uuid[];
+            delta_sums bigint[];
+            delta_counts bigint[];
+        BEGIN
+            IF pg_trigger_depth() > 1 OR current_setting('mm.skip_cascade', true) = 'on' OR 
+                NOT EXISTS (SELECT 1 FROM new_items) THEN
+                RETURN NULL;
+            END IF;
+            PERFORM refresh_paths(ARRAY(
+                SELECT new_items.id FROM new_items JOIN old_items ON old_items.id = new_items.id 
+                WHERE new_items."parentId" IS DISTINCT FROM old_items."parentId"));
+            SELECT array_agg(d."parentId"), array_agg(d.s), array_agg(d.c) INTO delta_ids, delta_sums, delta_counts 
+            FROM (
+                SELECT "parentId", SUM(s)::bigint AS s, SUM(c)::bigint AS c FROM (
+                    SELECT "parentId", 
+                        CASE WHEN type = 'OFFER' THEN price ELSE offer_sum END AS s, 
+                        CASE WHEN type = 'OFFER' THEN 1 ELSE offer_count END AS c 
+                    FROM new_items
+                UNION ALL
+                    SELECT "parentId", 
+                        -CASE WHEN type = 'OFFER' THEN price ELSE offer_sum END, 
+                        -CASE WHEN type = 'OFFER' THEN 1 ELSE offer_count END 
+                    FROM old_items
+                ) AS changes 
+                WHERE "parentId" IS NOT NULL 
+                GROUP BY "parentId"
+            ) AS d;
+            PERFORM update_ancestors(
+                ARRAY(SELECT id FROM new_items), 
+                ARRAY(SELECT "parentId" FROM new_items UNION SELECT "parentId" FROM old_items), 
+                (SELECT MAX(date) FROM new_items), 
+                delta_ids, delta_sums, delta_counts);
+            RETURN NULL;
+        END;
+        $$
+        LANGUAGE 'plpgsql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_insert_in_cat(self, connection: Connection):
         command = '''
         CREATE OR REPLACE FUNCTION insert_in_cat_func() 
         RETURNS trigger AS 
         $$
+        DECLARE 
+            adopted uuid[];
+            delta_ids uuid[];
+            delta_sums bigint[];
+            delta_counts bigint[];
         BEGIN
-            IF NEW."parentId" IS NOT NULL THEN
-                UPDATE items SET date = NEW.date WHERE id = NEW."parentId";
-                IF NEW.type = 'OFFER' THEN 
-                    UPDATE items SET price = (SELECT * FROM get_avg_price(NEW."parentId") as avg) WHERE id = NEW."parentId";
-                END IF;
+            IF pg_trigger_depth() > 1 OR current_setting('mm.skip_cascade', true) = 'on' OR 
+                NOT EXISTS (SELECT 1 FROM new_items) THEN
+                RETURN NULL;
             END IF;
-            RETURN NEW;
+            -- элементы, импортированные раньше родителя, входят в поддерево, только если родитель - категория; 
+            -- строки мягко удаленного поддерева, оставшиеся от прежнего элемента с тем же id, не входят
+            adopted := ARRAY(
+                SELECT id FROM items 
+                WHERE "parentId" IN (SELECT id FROM new_items WHERE type = 'CATEGORY') AND 
+                    id NOT IN (SELECT id FROM new_items) AND NOT path && ARRAY(SELECT id FROM tombstones));
+            PERFORM refresh_paths(ARRAY(SELECT id FROM new_items) || adopted);
+            SELECT array_agg("parentId"), array_agg(s), array_agg(c) INTO delta_ids, delta_sums, delta_counts 
+            FROM (
+                SELECT "parentId", SUM(s)::bigint AS s, SUM(c)::bigint AS c FROM (
+                    SELECT "parentId", price AS s, 1 AS c FROM new_items 
+                    WHERE type = 'OFFER' AND "parentId" IS NOT NULL
+                UNION ALL
+                    SELECT "parentId", 
+                        CASE WHEN type = 'OFFER' THEN price ELSE offer_sum END, 
+                        CASE WHEN type = 'OFFER' THEN 1 ELSE offer_count END 
+                    FROM items WHERE id = ANY(adopted)
+                ) AS changes 
+                GROUP BY "parentId"
+            ) AS d;
+            PERFORM update_ancestors(
+                ARRAY(SELECT id FROM new_items), 
+                ARRAY(SELECT "parentId" FROM new_items UNION SELECT "parentId" FROM items WHERE id = ANY(adopted)), 
+                (SELECT MAX(date) FROM new_items), 
+                delta_ids, delta_sums, delta_counts);
+            RETURN NULL;
         END;
         $$
         LANGUAGE 'plpgsql';
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_function_delete_from_cat(self):
+    async def create_function_delete_from_cat(self, connection: Connection):
         command = '''
         CREATE OR REPLACE FUNCTION delete_from_cat_func() 
         RETURNS trigger AS 
         $$
+        DECLARE 
+            removed uuid[];
+            delta_ids uuid[];
+            delta_sums bigint[];
+            delta_counts bigint[];
         BEGIN
-            IF OLD."parentId" IS NOT NULL THEN
-                UPDATE items SET price = (SELECT * FROM get_avg_price(OLD."parentId")) WHERE id = OLD."parentId";
+            IF pg_trigger_depth() > 1 OR current_setting('mm.skip_cascade', true) = 'on' OR 
+                NOT EXISTS (SELECT 1 FROM old_items) THEN
+                RETURN NULL;
             END IF;
-            RETURN NEW;
+            -- мягко удаленные поддеревья внутри удаляемого остаются фоновой очистке
+            WITH deleted AS (
+                DELETE FROM items 
+                WHERE path && ARRAY(SELECT id FROM old_items WHERE type = 'CATEGORY') AND 
+                    NOT path && ARRAY(SELECT id FROM tombstones) 
+                RETURNING id
+            ) 
+            SELECT array_agg(id) INTO removed FROM deleted;
+            
+            DELETE FROM items_history 
+            WHERE item_id = ANY(ARRAY(SELECT id FROM old_items) || removed) OR 
+                "item_parentId" = ANY(ARRAY(SELECT id FROM old_items WHERE type = 'CATEGORY'));
+            
+            SELECT array_agg("parentId"), array_agg(s), array_agg(c) INTO delta_ids, delta_sums, delta_counts 
+            FROM (
+                SELECT "parentId", 
+                    -SUM(CASE WHEN type = 'OFFER' THEN price ELSE offer_sum END)::bigint AS s, 
+                    -SUM(CASE WHEN type = 'OFFER' THEN 1 ELSE offer_count END)::bigint AS c 
+                FROM old_items 
+                WHERE "parentId" IN (SELECT id FROM items) 
+                GROUP BY "parentId"
+            ) AS d;
+            PERFORM update_ancestors(ARRAY[]::uuid[], delta_ids, NULL, delta_ids, delta_sums, delta_counts);
+            PERFORM notify_items_changed(ARRAY(SELECT id FROM old_items) || removed);
+            RETURN NULL;
         END;
         $$
         LANGUAGE 'plpgsql';
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_function_delete_cat(self):
+    async def create_function_soft_delete_item(self, connection: Connection):
         command = '''
-        CREATE OR REPLACE FUNCTION delete_cat_func() 
-        RETURNS trigger AS 
+        CREATE OR REPLACE FUNCTION soft_delete_item(item_id uuid) 
+        RETURNS boolean AS 
         $$
+        DECLARE 
+            target items%ROWTYPE;
         BEGIN
-            DELETE FROM items_history WHERE item_id = OLD.id;
-            IF OLD.type = 'CATEGORY' THEN
-                DELETE FROM items WHERE "parentId" = OLD.id;
-                DELETE FROM items_history WHERE "item_parentId" = OLD.id;
+            SELECT * INTO target FROM items WHERE id = item_id AND NOT path && ARRAY(SELECT id FROM tombstones);
+            IF NOT FOUND THEN
+                RETURN false;
             END IF;
-            RETURN NEW;
+            INSERT INTO tombstones (id) VALUES (item_id);
+            -- вклад поддерева вычитается из предков один раз, как при удалении его корня; 
+            -- триггер изменения не должен пересчитывать предков повторно
+            PERFORM set_config('mm.skip_cascade', 'on', true);
+            PERFORM update_ancestors(ARRAY[]::uuid[], ARRAY[target."parentId"], NULL, ARRAY[target."parentId"], 
+                ARRAY[-CASE WHEN target.type = 'OFFER' THEN target.price ELSE target.offer_sum END]::bigint[], 
+                ARRAY[-CASE WHEN target.type = 'OFFER' THEN 1 ELSE target.offer_count END]::bigint[]);
+            PERFORM set_config('mm.skip_cascade', 'off', true);
+            -- предков уведомил update_ancestors; перечислять поддерево - значит читать его целиком, 
+            -- а большое поддерево все равно превратилось бы в сброс кэша
+            PERFORM pg_notify('items_changed', '*');
+            RETURN true;
         END;
         $$
         LANGUAGE 'plpgsql';
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_function_get_avg_price(self):
+    async def create_function_purge_deleted(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION purge_deleted(roots uuid[], batch integer) 
+        RETURNS integer AS 
+        $$
+        DECLARE 
+            removed uuid[];
+            categories uuid[];
+        BEGIN
+            -- roots NULL - все мягко удаленные поддеревья; batch NULL - поддеревья целиком
+            roots := COALESCE(roots, ARRAY(SELECT id FROM tombstones));
+            IF cardinality(roots) = 0 THEN
+                RETURN 0;
+            END IF;
+            -- цены предков уже пересчитаны при мягком удалении, поэтому триггер удаления не нужен
+            PERFORM set_config('mm.skip_cascade', 'on', true);
+            IF batch IS NULL THEN
+                WITH deleted AS (
+                    DELETE FROM items WHERE path && roots RETURNING id, type
+                ) 
+                SELECT array_agg(id), array_agg(id) FILTER (WHERE type = 'CATEGORY') INTO removed, categories 
+                FROM deleted;
+            ELSE
+                -- строки, заблокированные импортом, пропускаются до следующей пачки: очистка никого не ждет
+                WITH doomed AS (
+                    SELECT id FROM items WHERE path && roots LIMIT batch FOR UPDATE SKIP LOCKED
+                ), 
+                deleted AS (
+                    DELETE FROM items WHERE id IN (SELECT id FROM doomed) RETURNING id, type
+                ) 
+                SELECT array_agg(id), array_agg(id) FILTER (WHERE type = 'CATEGORY') INTO removed, categories 
+                FROM deleted;
+            END IF;
+            
+            DELETE FROM items_history WHERE item_id = ANY(removed) OR "item_parentId" = ANY(categories);
+            DELETE FROM tombstones WHERE NOT EXISTS (SELECT 1 FROM items WHERE path @> ARRAY[tombstones.id]);
+            PERFORM set_config('mm.skip_cascade', 'off', true);
+            RETURN COALESCE(cardinality(removed), 0);
+        END;
+        $$
+        LANGUAGE 'plpgsql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_reclaim_deleted(self, connection: Connection):
+        command = '''
+        CREATE OR REPLACE FUNCTION reclaim_deleted(ids uuid[], parents uuid[], batch integer) 
+        RETURNS void AS 
+        $$
+        DECLARE 
+            roots uuid[];
+            detached uuid[];
+        BEGIN
+            -- повторно импортируемый корень мягко удаленного поддерева попал бы под собственную запись 
+            -- в tombstones, поэтому остаток поддерева удаляется сразу - если в нем не больше batch строк
+            roots := ARRAY(SELECT id FROM tombstones WHERE id = ANY(ids));
+            IF cardinality(roots) > 0 THEN
+                IF (SELECT count(*) FROM (SELECT 1 FROM items WHERE path && roots LIMIT batch + 1) AS rest) > batch THEN
+                    RAISE EXCEPTION 'Удаленное поддерево еще очищается' USING ERRCODE = 'object_in_use';
+                END IF;
+                PERFORM purge_deleted(roots, NULL);
+            END IF;
+            -- остальные скрытые строки, которые импорт создает заново или делает родителями, удаляются по одной; 
+            -- их потомки остаются скрытыми под своей записью в tombstones до фоновой очистки
+            PERFORM set_config('mm.skip_cascade', 'on', true);
+            WITH deleted AS (
+                DELETE FROM items 
+                WHERE id IN (SELECT unnest(ids) UNION SELECT unnest(parents)) AND 
+                    path && ARRAY(SELECT id FROM tombstones) 
+                RETURNING id
+            ) 
+            SELECT array_agg(id) INTO detached FROM deleted;
+            DELETE FROM items_history WHERE item_id = ANY(detached);
+            PERFORM set_config('mm.skip_cascade', 'off', true);
+        END;
+        $$
+        LANGUAGE 'plpgsql';
+        '''
+        await self.execute(command, execute=True, connection=connection)
+
+    async def create_function_get_avg_price(self, connection: Connection):
         command = '''
         CREATE OR REPLACE FUNCTION get_avg_price(cat_id UUID) 
         RETURNS integer AS 
         $$
         BEGIN
             RETURN CAST(ROUND(AVG(price)-0.5) AS INT) FROM items 
-                WHERE type = 'OFFER' AND "parentId" IN (
-                    WITH RECURSIVE temp AS (
-                        SELECT CAST($1 AS uuid) AS id
-                    UNION
-                        SELECT items.id FROM items JOIN temp ON (items."parentId" = uuid(temp.id) AND type = 'CATEGORY')
-                    ) 
-                    SELECT * FROM temp);
+                WHERE type = 'OFFER' AND path @> ARRAY[cat_id] AND NOT path && ARRAY(SELECT id FROM tombstones);
         END;
         $$
         LANGUAGE 'plpgsql';
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def create_function_check_errors(self):
+    async def create_function_check_errors(self, connection: Connection):
         command = '''
         CREATE OR REPLACE FUNCTION check_errors_func() 
         RETURNS trigger AS 
@@ -327,77 +1203,408 @@ class MMDatabase(DatabaseCore):
         $$
         LANGUAGE 'plpgsql';
         '''
-        await self.execute(command, execute=True)
+        await self.execute(command, execute=True, connection=connection)
 
-    async def insert_items(self, items: List[tuple]):
-        command = '''
-        INSERT INTO items (id, name, date, "parentId", type, price) 
-        VALUES ($1, $2, $3, $4, $5, $6) 
-        ON CONFLICT (id) DO UPDATE 
-        SET (name, date, "parentId", type, price) = ($2, $3, $4, $5, $6) 
-        '''
-        await self.execute(command, items, executemany=True)
+    async def insert_items(self, items: List[tuple], connection: Connection = None) -> Dict[str, int]:
+        """ Импорт пачки элементов: COPY во временную таблицу и одно слияние с items.
+        Даты, цены родительских категорий и история пересчитываются триггерами один раз на всю пачку.
+        Возвращает число вставленных, измененных и удаленных строк по таблицам. """
+        return await self.insert_item_batches(single_batch(items), connection)
+
+    async def insert_item_batches(self, batches: AsyncIterator[List[tuple]],
+                                  connection: Connection = None) -> Dict[str, int]:
+        """ То же для импорта, который читается по частям: каждая часть сразу копируется во временную таблицу,
+        так что в памяти держится одна часть, а слияние с items и триггеры выполняются один раз в конце.
+        Повторный id в импорте - UniqueViolationError; повторный импорт корня мягко удаленного поддерева,
+        которое фоновая очистка еще не успела уменьшить до purge_batch_size строк, - ObjectInUseError. """
+        if connection is None:
+            async with self.acquire() as connection:
+                return await self.insert_item_batches(batches, connection)
+        started = perf_counter()
+        count = 0
+        async with self.transaction(connection):
+            await connection.execute('''
+            CREATE TEMP TABLE items_import (
+                id uuid PRIMARY KEY,
+                name VARCHAR (255),
+                date TIMESTAMP with time zone,
+                "parentId" uuid,
+                type item_type,
+                price INT
+            ) ON COMMIT DROP;
+            ''')
+            async for items in batches:
+                await connection.copy_records_to_table('items_import', records=items,
+                                                       columns=('id', 'name', 'date', 'parentId', 'type', 'price'))
+                count += len(items)
+            # Элементы и их предки (прежние и новые) блокируются заранее в порядке id, а новые строки
+            # вставляются в том же порядке: иначе параллельные импорты с общими предками, которые триггеры
+            # обновляют в произвольном порядке, взаимно блокируются
+            await connection.execute('''
+            SELECT 1 FROM items 
+            WHERE id IN (
+                SELECT unnest(path) FROM items 
+                WHERE id IN (SELECT id FROM items_import UNION SELECT "parentId" FROM items_import)
+            ) 
+            ORDER BY id 
+            FOR UPDATE;
+            ''')
+            # Импорт создает элементы мягко удаленных поддеревьев заново, а не меняет скрытые строки: эти строки
+            # удаляются, а остальные строки поддеревьев остаются фоновой очистке. Синхронно удаляется не больше
+            # строк, чем элементов и родителей в импорте, плюс остаток поддерева, чей корень импортируется
+            # повторно, - не больше purge_batch_size строк, иначе ObjectInUseError (см. reclaim_deleted)
+            await connection.execute('''
+            SELECT reclaim_deleted(ARRAY(SELECT id FROM items_import), ARRAY(SELECT "parentId" FROM items_import), $1) 
+            WHERE EXISTS (SELECT 1 FROM tombstones);
+            ''', models.EnvSettings().purge_batch_size)
+            await connection.execute('''
+            INSERT INTO items (id, name, date, "parentId", type, price) 
+            SELECT id, name, date, "parentId", type, price FROM items_import ORDER BY id 
+            ON CONFLICT (id) DO UPDATE 
+            SET (name, date, "parentId", type, price) = 
+                (EXCLUDED.name, EXCLUDED.date, EXCLUDED."parentId", EXCLUDED.type, EXCLUDED.price);
+            ''')
+            touched = await connection.fetch('''
+            SELECT CASE WHEN relname LIKE 'items_history%' THEN 'items_history' ELSE relname END AS table, 
+                SUM(n_tup_ins + n_tup_upd + n_tup_del)::bigint AS rows 
+            FROM pg_stat_xact_user_tables 
+            WHERE schemaname = current_schema() AND (relname = 'items' OR relname LIKE 'items_history%') 
+            GROUP BY 1;
+            ''')
+        elapsed = perf_counter() - started
+        self.metrics.observe_statement('insert_items', elapsed)
+        self.metrics.import_items.observe((), count)
+        for record in touched:
+            self.metrics.import_rows.observe((record['table'], ), record['rows'])
+        logger.info('Импорт %d элементов за %.3f с (%.0f строк/с)', count, elapsed, count / elapsed)
+        return {record['table']: record['rows'] for record in touched}
+
+    async def check_aggregates(self):
+        command = '''SELECT * FROM check_aggregates();'''
+        return await self.execute(command, fetch=True, readonly=True)
 
-    async def delete_item(self, uuid):
-        command = '''DELETE FROM items WHERE id = $1 or "parentId" = $1 IS TRUE RETURNING 1;'''
-        await self.execute(command, (uuid, ), execute=True)
+    async def rebuild_aggregates(self, connection: Connection = None):
+        command = '''SELECT rebuild_aggregates();'''
+        return await self.execute(command, fetchval=True, connection=connection)
 
-    async def get_item(self, uuid):
-        command = '''SELECT * FROM items WHERE id = $1;'''
-        return await self.execute(command, (uuid, ), fetchrow=True)
+    async def check_paths(self):
+        command = '''SELECT * FROM check_paths();'''
+        return await self.execute(command, fetch=True, readonly=True)
 
-    async def get_item_children(self, uuid):
-        command = '''SELECT * FROM items WHERE "parentId" = $1;'''
-        return await self.execute(command, (uuid, ), fetch=True)
+    async def rebuild_paths(self, connection: Connection = None):
+        command = '''SELECT rebuild_paths();'''
+        return await self.execute(command, fetchval=True, connection=connection)
 
-    async def get_avg_price(self, cat_id):
+    async def listen(self, channel: str, callback) -> Connection:
+        """ Отдельное от пула соединение, подписанное на уведомления channel """
+        env = models.EnvSettings()
+        connection = await asyncpg.connect(host=env.postgres_host, port=env.postgres_port, user=env.postgres_user, password=env.postgres_password, database=env.postgres_db)
+        await connection.add_listener(channel, callback)
+        return connection
+
+    async def create_history_partitions(self, months_ahead: int, connection: Connection = None):
+        command = '''SELECT create_history_partitions($1);'''
+        return await self.execute(command, (months_ahead, ), fetchval=True, connection=connection)
+
+    async def archive_history(self, before: datetime, archive_dir: Path) -> List[Path]:
+        """ Отсоединяет секции истории, целиком лежащие раньше before, выгружает их в сжатые CSV-файлы
+        в archive_dir и удаляет. Секции, отсоединенные при прерванном ранее запуске, дообрабатываются. """
         command = '''
-            SELECT CAST(ROUND(AVG(price)-0.5) AS INT) FROM items 
-                WHERE type = 'OFFER' AND "parentId" IN (
-                    WITH RECURSIVE temp AS (
-                        SELECT CAST($1 AS uuid) AS id
-                    UNION
-                        SELECT items.id FROM items JOIN temp ON (items."parentId" = uuid(temp.id) AND type = 'CATEGORY')
-                    ) 
-                    SELECT * FROM temp);
-            '''
-        return await self.execute(command, (cat_id,), fetchval=True)
+        SELECT relname AS name, EXISTS(SELECT 1 FROM pg_inherits WHERE inhrelid = pg_class.oid) AS attached 
+        FROM pg_class 
+        WHERE relkind = 'r' AND relnamespace = current_schema()::regnamespace AND 
+            relname ~ '^items_history_[0-9]{4}_[0-9]{2}$' AND 
+            (to_date(right(relname, 7), 'YYYY_MM') + interval '1 month') AT TIME ZONE 'UTC' <= $1 
+        ORDER BY relname;
+        '''
+        archive_dir.mkdir(parents=True, exist_ok=True)
+        archived = []
+        async with self.acquire() as connection:
+            connection: Connection
+            for partition in await connection.fetch(command, before):
+                name = partition['name']
+                if partition['attached']:
+                    await connection.execute(f'''ALTER TABLE items_history DETACH PARTITION {name};''')
+                file = archive_dir / f'{name}.csv.gz'
+                part = file.with_name(file.name + '.part')
+                with gzip.open(part, 'wb') as output:
+                    await connection.copy_from_table(name, output=output, format='csv', header=True)
+                part.replace(file)
+                await connection.execute(f'''DROP TABLE {name};''')
+                logger.info('Секция %s выгружена в %s', name, file)
+                archived.append(file)
+        return archived
 
-    async def get_last_24h(self, date):
+    async def maintain_history(self):
+        """ Создает будущие секции истории и выгружает в архив устаревшие, если задан срок хранения.
+        Выполняется одним воркером: остальные в это время пропускают запуск. """
+        env = models.EnvSettings()
+        async with self.acquire() as connection:
+            connection: Connection
+            if not await connection.fetchval('''SELECT pg_try_advisory_lock($1);''', HISTORY_LOCK_ID):
+                return
+            try:
+                await self.create_history_partitions(env.history_partitions_ahead, connection)
+                if env.history_retention_days is not None:
+                    before = datetime.now(timezone.utc) - timedelta(days=env.history_retention_days)
+                    await self.archive_history(before, Path(env.history_archive_dir))
+            finally:
+                await connection.execute('''SELECT pg_advisory_unlock($1);''', HISTORY_LOCK_ID)
+
+    async def add_import_job(self, items: str, update_date: datetime, item_count: int,
+                             connection: Connection = None) -> Record:
+        """ Ставит импорт в очередь; items - JSON-массив элементов в формате ShopUnitImport """
+        command = '''
+        INSERT INTO import_jobs (update_date, items, item_count) VALUES ($1, $2, $3) 
+        RETURNING id, status, item_count AS items, (
+            SELECT count(*) FROM import_jobs AS earlier 
+            WHERE earlier.status IN ('queued', 'running') AND earlier.seq < import_jobs.seq
+        ) AS ahead, attempts, rows_touched AS rows, error, created, started, finished;
+        '''
+        return await self.execute(command, (update_date, items, item_count), fetchrow=True, connection=connection)
+
+    async def get_import_job(self, job_id, connection: Connection = None) -> Union[Record, None]:
+        """ Состояние задания; ahead - сколько заданий выполнится раньше него, пока оно ждет в очереди """
         command = '''
-        SELECT item_id as id, item_name as name, item_date as date, "item_parentId" as "parentId", item_type as type, item_price as price  
-        FROM items_history WHERE item_type = 'OFFER' AND item_date <= $1 AND item_date >= $1 - INTERVAL '24 hour';
+        SELECT id, status, item_count AS items, 
+            CASE WHEN status = 'queued' THEN (
+                SELECT count(*) FROM import_jobs AS earlier 
+                WHERE earlier.status IN ('queued', 'running') AND earlier.seq < import_jobs.seq
+            ) END AS ahead, 
+            attempts, rows_touched AS rows, error, created, started, finished 
+        FROM import_jobs WHERE id = $1;
+        '''
+        return await self.execute(command, (job_id, ), fetchrow=True, connection=connection)
+
+    async def process_import_jobs(self) -> Union[int, None]:
+        """ Выполняет задания очереди импортов по одному в порядке поступления, пока она не опустеет.
+        Очередь разбирает один обработчик на всю БД (advisory-блокировка): задания с общими элементами
+        или предками должны применяться в том же порядке, что и синхронные импорты одного клиента.
+        Задание выполняется в одной транзакции с отметкой о завершении; прерванное задание ('running'
+        без обработчика) выполняется заново. Если первое задание ждет повтора, очередь стоит до его срока:
+        следующие задания не обгоняют его. Возвращает число выполненных заданий либо None, если
+        очередь уже разбирает другой обработчик. """
+        async with self.acquire() as connection:
+            connection: Connection
+            if not await connection.fetchval('''SELECT pg_try_advisory_lock($1);''', IMPORT_JOBS_LOCK_ID):
+                return None
+            try:
+                processed = 0
+                while await self.process_import_job(connection):
+                    processed += 1
+                return processed
+            finally:
+                await connection.execute('''SELECT pg_advisory_unlock($1);''', IMPORT_JOBS_LOCK_ID)
+
+    async def process_import_job(self, connection: Connection) -> bool:
+        """ Выполняет первое задание очереди; False, если очередь пуста или первое задание ждет повтора.
+        Задание, откаченное из-за взаимоблокировки, конфликта сериализации или еще не очищенного удаленного
+        поддерева, возвращается в очередь с задержкой import_jobs_retry_delay секунд, удваивающейся с каждой
+        попыткой; после import_jobs_max_attempts попыток оно отклоняется с последней ошибкой. Попытка засчитывается
+        при взятии задания, поэтому и задание, раз за разом прерываемое падением воркера, не повторяется бесконечно. """
+        env = models.EnvSettings()
+        job = await connection.fetchrow('''
+        UPDATE import_jobs SET status = 'running', started = now(), attempts = attempts + 1 
+        WHERE id = (SELECT id FROM import_jobs WHERE status IN ('queued', 'running') ORDER BY seq LIMIT 1) 
+            AND (retry_after IS NULL OR retry_after <= now()) 
+        RETURNING id, attempts;
+        ''')
+        if job is None:
+            return False
+        job_id = job['id']
+        finish = '''
+        UPDATE import_jobs SET status = $2, rows_touched = $3, error = $4, items = NULL, finished = now() WHERE id = $1;
         '''
-        return await self.execute(command, (date,), fetch=True)
-
-    async def get_statistics(self, uuid, date_start, date_end):
-        if date_start is None: date_start = datetime(1971, 1, 1, 0, 0)
-        if date_end is None: date_end = datetime(3000, 1, 1, 0, 0)
-        command = '''
-        SELECT item_id as id, item_name as name, item_date as date, "item_parentId" as "parentId", item_type as type, item_price as price   
-        FROM items_history 
-        WHERE 
-            item_id = $1 AND
-            item_date >= $2 AND
-            item_date < $3;
+        try:
+            async with self.transaction(connection):
+                items = await connection.fetch('''
+                SELECT item.id, item.name, job.update_date, item."parentId", item.type, item.price 
+                FROM import_jobs AS job, jsonb_to_recordset(job.items) 
+                    AS item(id uuid, name VARCHAR (255), "parentId" uuid, type item_type, price INT) 
+                WHERE job.id = $1;
+                ''', job_id)
+                touched = await self.insert_items(items, connection)
+                await connection.execute(finish, job_id, 'done', json.dumps(touched), None)
+        except (asyncpg.exceptions.TransactionRollbackError, asyncpg.exceptions.ObjectInUseError) as ex:
+            # взаимоблокировка или конфликт сериализации с другим импортом либо повторный импорт корня
+            # еще не очищенного поддерева (см. reclaim_deleted): задание повторится позже
+            if job['attempts'] >= env.import_jobs_max_attempts:
+                await connection.execute(finish, job_id, 'failed', None, ex.args[0] if ex.args else repr(ex))
+                logger.warning('Задание импорта %s не выполнено за %d попыток: %r', job_id, job['attempts'], ex)
+                return True
+            delay = env.import_jobs_retry_delay * 2 ** (job['attempts'] - 1)
+            await connection.execute('''
+            UPDATE import_jobs SET status = 'queued', error = $2, retry_after = now() + make_interval(secs => $3) 
+            WHERE id = $1;
+            ''', job_id, ex.args[0] if ex.args else repr(ex), delay)
+            logger.warning('Задание импорта %s будет повторено через %.1f с: %r', job_id, delay, ex)
+        except asyncpg.exceptions.PostgresError as ex:
+            await connection.execute(finish, job_id, 'failed', None, ex.args[0] if ex.args else repr(ex))
+            logger.warning('Задание импорта %s не выполнено: %r', job_id, ex)
+        return True
+
+    async def delete_item(self, uuid, connection: Connection = None) -> bool:
+        """ Удаляет элемент с поддеревом одним DELETE по path; историю и цены предков триггер обновляет
+        один раз на все поддерево. Поддерево и предки сначала блокируются в порядке id, как при импорте,
+        чтобы удаление и параллельные импорты не блокировали друг друга взаимно. False, если элемента нет.
+
+        Категория, в которой не меньше soft_delete_min_offers товаров, удаляется мягко: блокируются только
+        она и предки, корень поддерева записывается в tombstones, а цены предков пересчитываются один раз.
+        Чтение такое поддерево уже не видит, а строки и историю удаляет фоновая очистка (см. purge_deleted);
+        мягко удаленные поддеревья внутри удаляемого не блокируются и не удаляются - их тоже очистит она.
+        Способ удаления выбирается тем же запросом, что блокирует строки. """
+        if connection is None:
+            async with self.acquire() as connection:
+                return await self.delete_item(uuid, connection)
+        min_offers = models.EnvSettings().soft_delete_min_offers
+        async with self.transaction(connection):
+            soft = await self.execute(self.statements['lock_item'], (uuid, min_offers), fetchval=True,
+                                      connection=connection)
+            if soft is None:
+                return False
+            if soft:
+                return await self.execute('''SELECT soft_delete_item($1);''', (uuid, ), fetchval=True,
+                                          connection=connection)
+            return bool(await self.execute(self.statements['delete_item'], (uuid, ), fetchval=True,
+                                           connection=connection))
+
+    async def get_deleted(self, connection: Connection = None) -> List[Record]:
+        """ Мягко удаленные поддеревья, которые еще не очищены, и число оставшихся в них строк items """
+        command = '''
+        SELECT id, created, (SELECT count(*) FROM items WHERE path @> ARRAY[tombstones.id]) AS rows 
+        FROM tombstones ORDER BY created;
         '''
-        return await self.execute(command, (uuid, date_start, date_end), fetch=True)
+        return await self.execute(command, fetch=True, connection=connection)
 
-    async def item_exists(self, uuid):
-        command = '''SELECT EXISTS(SELECT id FROM items WHERE id = $1);'''
-        return await self.execute(command, (uuid, ), fetchval=True)
+    async def purge_deleted(self, batch_size: int, pause: float) -> Union[int, None]:
+        """ Удаляет строки и историю мягко удаленных поддеревьев пачками по batch_size строк items,
+        каждую в своей транзакции, с паузой pause секунд между ними, пока не удалит все доступные.
+        Выполняется одним воркером на всю БД; возвращает число удаленных строк items либо None,
+        если очистку уже выполняет другой воркер. """
+        async with self.acquire() as connection:
+            connection: Connection
+            if not await connection.fetchval('''SELECT pg_try_advisory_lock($1);''', PURGE_LOCK_ID):
+                return None
+            try:
+                purged = 0
+                while True:
+                    async with self.transaction(connection):
+                        removed = await self.execute('''SELECT purge_deleted(NULL, $1);''', (batch_size, ),
+                                                     fetchval=True, connection=connection)
+                    if not removed:
+                        return purged
+                    purged += removed
+                    await asyncio.sleep(pause)
+            finally:
+                await connection.execute('''SELECT pg_advisory_unlock($1);''', PURGE_LOCK_ID)
+
+    async def get_subtree(self, uuid, connection: Connection = None):
+        """ Элемент и все его потомки; пустой список, если элемента нет """
+        command = self.statements['get_subtree']
+        return await self.execute(command, (uuid, ), fetch=True, connection=connection, readonly=True)
+
+    async def get_wal_lsn(self, connection: Connection) -> int:
+        """ Позиция WAL, до которой видны изменения: воспроизведенная репликой либо текущая основного сервера """
+        command = '''SELECT (COALESCE(pg_last_wal_replay_lsn(), pg_current_wal_lsn()) - '0/0')::bigint;'''
+        return await self.execute(command, fetchval=True, connection=connection, readonly=True)
+
+    def get_last_24h(self, date, stream: bool = False, connection: Connection = None, replica: bool = True):
+        """ При stream=True возвращает асинхронный итератор пачек записей из серверного курсора
+        на собственном соединении из пула (с реплики, если replica и она исправна):
+        ответ отдается уже после завершения обработчика """
+        command = self.statements['get_last_24h']
+        if stream:
+            return self.iterate(command, (date,), replica=replica)
+        return self.execute(command, (date,), fetch=True, connection=connection, readonly=True)
+
+    async def get_statistics(self, uuid, date_start, date_end, after=None, limit=None,
+                             connection: Connection = None) -> Union[List[Record], None]:
+        """ История элемента по возрастанию (item_date, id). after - ключ (item_date, id) последней
+        записи предыдущей страницы, limit - размер страницы (None - без ограничения).
+        None, если элемента нет: наличие проверяется тем же запросом. """
+        after_date, after_id = after or (None, None)
+        command = self.statements['get_statistics']
+        records = await self.execute(command, (uuid, date_start, date_end, after_date, after_id, limit), fetch=True,
+                                     connection=connection, readonly=True)
+        return without_empty_row(records, 'history_id')
+
+    async def get_statistics_buckets(self, uuid, date_start, date_end, bucket: models.StatisticBucket,
+                                     connection: Connection = None) -> Union[List[Record], None]:
+        """ Первая, минимальная, максимальная и последняя цена элемента по интервалам bucket (границы по UTC).
+        None, если элемента нет. """
+        command = self.statements['get_statistics_buckets']
+        records = await self.execute(command, (uuid, date_start, date_end, bucket.value), fetch=True,
+                                     connection=connection, readonly=True)
+        return without_empty_row(records, 'date')
+
+
+def without_empty_row(records: List[Record], key: str) -> Union[List[Record], None]:
+    """ Результат LEFT JOIN LATERAL от строки элемента: нет строк - нет элемента,
+    одна строка с пустым key - элемент есть, но подходящих записей нет """
+    if not records:
+        return None
+    if records[0][key] is None:
+        return []
+    return records
+
+
+async def single_batch(items: List[tuple]) -> AsyncIterator[List[tuple]]:
+    yield items
+
+
+def schema_fingerprint() -> str:
+    """ Отпечаток схемы: тексты команд и вызовы методов, создающих объекты БД, и файлы миграций """
+    digest = hashlib.sha256()
+    for name, member in sorted(vars(MMDatabase).items()):
+        if name.startswith('create_'):
+            code = member.__code__
+            digest.update(name.encode())
+            digest.update(repr([const for const in code.co_consts if isinstance(const, (str, int))]).encode())
+            digest.update(repr(code.co_names).encode())
+    for migration in read_migrations():
+        digest.update(migration.sql.encode())
+    return digest.hexdigest()
 
 
 async def main():
-    from datetime import datetime
-    from pprint import pprint
-    from time import time
+    import argparse
+    parser = argparse.ArgumentParser(description='Обслуживание БД MegaMarket')
+    subparsers = parser.add_subparsers(dest='command')
+    check = subparsers.add_parser('check-aggregates',
+                                  help='Сверить суммы и количества товаров категорий с рекурсивным расчетом')
+    check.add_argument('--rebuild', action='store_true', help='Пересчитать расхождения')
+    check = subparsers.add_parser('check-paths', help='Сверить материализованные пути с цепочками parentId')
+    check.add_argument('--rebuild', action='store_true', help='Пересчитать расхождения')
+    subparsers.add_parser('migrations', help='Показать примененные и ожидающие миграции схемы')
+    subparsers.add_parser('maintain-history',
+                          help='Создать будущие секции истории и выгрузить в архив устаревшие')
+    args = parser.parse_args()
+
     db = MMDatabase()
     await db.create_pool()
+    if args.command == 'check-aggregates':
+        wrong = await db.check_aggregates()
+        for record in wrong:
+            print(dict(record))
+        print(f'Расхождений: {len(wrong)}')
+        if wrong and args.rebuild:
+            print(f'Пересчитано категорий: {await db.rebuild_aggregates()}')
+    elif args.command == 'check-paths':
+        wrong = await db.check_paths()
+        for record in wrong:
+            print(dict(record))
+        print(f'Расхождений: {len(wrong)}')
+        if wrong and args.rebuild:
+            print(f'Пересчитано путей: {await db.rebuild_paths()}')
+    elif args.command == 'migrations':
+        done = await db.get_applied_migrations()
+        for migration in read_migrations():
+            status = 'применена' if migration.version in done else 'ожидает'
+            print(f'{migration.version:04d}_{migration.name}: {status}')
+    elif args.command == 'maintain-history':
+        await db.maintain_history()
 
 
 if __name__ == '__main__':
-    import asyncio
-
     loop = asyncio.get_event_loop()
     loop.run_until_complete(main())
@@ -0,0 +1,25 @@
+""" Производственный профиль: gunicorn запускает и перезапускает воркеры uvicorn на uvloop и httptools.
+
+    gunicorn -c gunicorn.conf.py main:app
+
+Число воркеров - WEB_CONCURRENCY, по умолчанию по числу ядер. Оно передается воркерам через окружение,
+и каждый уменьшает свой пул так, чтобы все вместе уложились в POSTGRES_MAX_CONNECTIONS (см. database.pool_max_size).
+"""
+import multiprocessing
+import os
+from uvicorn.workers import UvicornWorker
+
+
+class Worker(UvicornWorker):
+    CONFIG_KWARGS = {'loop': 'uvloop', 'http': 'httptools'}
+
+
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_class = Worker
+bind = os.environ.get('BIND', '0.0.0.0:80')
+keepalive = 5
+# Воркер, переставший отвечать мастеру, перезапускается; при остановке запросам дается время завершиться
+timeout = 60
+graceful_timeout = 30
+accesslog = '-'
@@ -1,14 +1,21 @@
+import asyncio
+import base64
+import logging
 import asyncpg.exceptions
 from fastapi import FastAPI
 from fastapi.openapi.utils import get_openapi
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import responses
 import models
-from fastapi import Path, Query
-from database import MMDatabase
+from fastapi import Depends, Header, HTTPException, Path, Query, Request, Response
+from database import MMDatabase, RequestConnection
+from cache import SubtreeCache
+from coalescer import ImportCoalescer
+from metrics import Metrics, MetricsMiddleware
+from slow_queries import SlowQueryLog
 import openapi_editor
-from pprint import pprint
+import serialization
 
 
 def custom_openapi():
@@ -28,8 +35,13 @@ def custom_openapi():
     return app.openapi_schema
 
 
+logger = logging.getLogger(__name__)
+
+NDJSON = 'application/x-ndjson'
+
 app = FastAPI(title="MegaMarket API", version="1.0.0", description="*by Biktimirov A.S.*",)
 app.openapi = custom_openapi
+app.add_middleware(MetricsMiddleware)
 
 
 @app.on_event('startup')
@@ -37,6 +49,124 @@ async def create_db_pool():
     db = MMDatabase()
     await db.create_pool()
     await db.db_init()
+    app.state.history_maintenance = asyncio.create_task(maintain_history())
+    app.state.nodes_cache_invalidation = asyncio.create_task(invalidate_nodes_cache())
+    app.state.replica_monitoring = asyncio.create_task(monitor_replica())
+    app.state.import_jobs_added = asyncio.Event()
+    app.state.import_jobs = asyncio.create_task(process_import_jobs())
+    app.state.purge_requested = asyncio.Event()
+    app.state.purge = asyncio.create_task(purge_deleted())
+
+
+@app.on_event('shutdown')
+async def close_db_pool():
+    """ Останавливает фоновые задачи и закрывает пул, дождавшись завершения текущих запросов """
+    tasks = [app.state.history_maintenance, app.state.nodes_cache_invalidation, app.state.replica_monitoring,
+             app.state.import_jobs, app.state.purge]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await MMDatabase().close_pool()
+
+
+async def maintain_history():
+    """ Периодически создает будущие секции истории и архивирует устаревшие """
+    db = MMDatabase()
+    interval = models.EnvSettings().history_maintenance_interval
+    while True:
+        try:
+            await db.maintain_history()
+        except Exception:
+            logger.exception('Ошибка обслуживания секций истории')
+        await asyncio.sleep(interval)
+
+
+async def invalidate_nodes_cache():
+    """ Держит LISTEN-соединение и вычищает из кэша /nodes поддеревья измененных элементов.
+    Пока соединения нет, кэш выключен: пропущенные уведомления сделали бы его устаревшим. """
+    db = MMDatabase()
+    cache = SubtreeCache()
+    if not cache.max_bytes:
+        return
+    while True:
+        lost = asyncio.Event()
+        try:
+            connection = await db.listen('items_changed', lambda *args: cache.invalidate(args[-1]))
+        except Exception:
+            logger.exception('Нет LISTEN-соединения для кэша /nodes')
+            await asyncio.sleep(5)
+            continue
+        connection.add_termination_listener(lambda *args: lost.set())
+        cache.clear()
+        cache.connection = connection
+        cache.enabled = True
+        cache.track_lsn = db.replica is not None
+        cache.update_lsn()
+        try:
+            await lost.wait()
+        finally:
+            cache.enabled = False
+            cache.clear()
+            await connection.close()
+
+
+async def monitor_replica():
+    """ Периодически проверяет реплику: чтение идет на нее, только пока она доступна и не отстает """
+    db = MMDatabase()
+    if db.replica is None:
+        return
+    interval = models.EnvSettings().postgres_replica_check_interval
+    while True:
+        await db.check_replica()
+        await asyncio.sleep(interval)
+
+
+async def process_import_jobs():
+    """ Разбирает очередь асинхронных импортов: сразу после постановки задания этим воркером,
+    а также раз в import_jobs_poll_interval секунд - для заданий других воркеров и прерванных перезапуском.
+    Задания выполняет один воркер за раз (см. MMDatabase.process_import_jobs). """
+    db = MMDatabase()
+    added: asyncio.Event = app.state.import_jobs_added
+    interval = models.EnvSettings().import_jobs_poll_interval
+    while True:
+        added.clear()
+        try:
+            await db.process_import_jobs()
+        except Exception:
+            logger.exception('Ошибка обработки очереди импортов')
+        try:
+            await asyncio.wait_for(added.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def purge_deleted():
+    """ Удаляет строки мягко удаленных поддеревьев: сразу после удаления этим воркером, а также раз
+    в purge_interval секунд - для удалений других воркеров и прерванной очистки """
+    db = MMDatabase()
+    requested: asyncio.Event = app.state.purge_requested
+    env = models.EnvSettings()
+    while True:
+        requested.clear()
+        try:
+            await db.purge_deleted(env.purge_batch_size, env.purge_pause)
+        except Exception:
+            logger.exception('Ошибка очистки мягко удаленных поддеревьев')
+        try:
+            await asyncio.wait_for(requested.wait(), env.purge_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def request_connection(request: Request):
+    """ Одно соединение из пула на все обращения к БД в рамках запроса. С заголовком
+    X-Read-Your-Writes: 1 чтение идет на основной сервер, минуя реплику, - например, сразу после импорта. """
+    read_your_writes = request.headers.get('x-read-your-writes', '').lower() in ('1', 'true', 'yes')
+    connection = RequestConnection(MMDatabase(), read_your_writes)
+    try:
+        yield connection
+    finally:
+        await connection.release()
 
 
 @app.exception_handler(RequestValidationError)
@@ -46,67 +176,192 @@ async def validation_exception_handler(request, exc):
 
 
 @app.post('/imports', responses=responses.imports_responses, status_code=200, tags=[models.Tags.main])
-async def imports(data: models.ShopUnitImportRequest):
+async def imports(data: models.ShopUnitImportRequest, connection: RequestConnection = Depends(request_connection)):
     """ Импортирует новые товары и/или категории. Товары/категории импортированные повторно обновляют текущие. """
 
     db = MMDatabase()
-    ids = list(map(lambda x: x.id, data.items))
-    if len(ids) != len(set(ids)):
-        raise RequestValidationError('Duplicate ids')
+    check_unique_ids(data)
 
     prepared_items = list(map(lambda x: (x.id, x.name, data.updateDate, x.parentId, x.type, x.price), data.items))
+    coalescer = ImportCoalescer()
     try:
-        res = await db.insert_items(prepared_items)
+        if coalescer.enabled:
+            await coalescer.insert_items(prepared_items)
+        else:
+            await db.insert_items(prepared_items, await connection.get())
     except asyncpg.exceptions.RaiseError as ex:
         raise RequestValidationError(ex.args[0])
-    return res
+    except asyncpg.exceptions.ObjectInUseError:
+        return being_purged()
+    await SubtreeCache().sync()
+
+
+@app.post('/imports/stream', responses=responses.imports_responses, status_code=200, tags=[models.Tags.additional],
+          openapi_extra={'requestBody': {'required': True, 'content': {NDJSON: {
+              'schema': {'$ref': '#/components/schemas/ShopUnitImport'}}}}})
+async def imports_stream(request: Request,
+                         updateDate: models.datetime =
+                         Query(description='Время обновления добавляемых товаров/категорий',
+                               example='2022-05-28T21:12:01.000Z'),
+                         connection: RequestConnection = Depends(request_connection)):
+    """ Импорт в формате NDJSON: по одному ShopUnitImport в строке. Элементы проверяются по мере чтения тела
+    и записываются во временную таблицу пачками, поэтому память не зависит от размера импорта.
+    Импорт применяется целиком, как и `/imports`. """
+
+    db = MMDatabase()
+    batches = ndjson_items(request, updateDate, models.EnvSettings().import_batch_size)
+    try:
+        await db.insert_item_batches(batches, await connection.get())
+    except (asyncpg.exceptions.RaiseError, asyncpg.exceptions.UniqueViolationError) as ex:
+        raise RequestValidationError(ex.args[0])
+    except asyncpg.exceptions.ObjectInUseError:
+        return being_purged()
+    await SubtreeCache().sync()
+
+
+def being_purged() -> JSONResponse:
+    """ Ответ на повторный импорт корня мягко удаленного поддерева, которое еще очищается: очистка
+    запускается сразу, и импорт можно повторить позже """
+    app.state.purge_requested.set()
+    return JSONResponse(content=models.Error(code=409, message='Item is being deleted').dict(), status_code=409)
+
+
+async def ndjson_items(request: Request, update_date: models.datetime, batch_size: int):
+    """ Читает тело запроса по частям и выдает проверенные элементы пачками по batch_size записей для COPY """
+    batch = []
+    rest = b''
+    async for chunk in request.stream():
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            if line.strip():
+                batch.append(parse_import_item(line, update_date))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if rest.strip():
+        batch.append(parse_import_item(rest, update_date))
+    if batch:
+        yield batch
+
+
+def parse_import_item(line: bytes, update_date: models.datetime) -> tuple:
+    try:
+        item = models.ShopUnitImport.parse_raw(line)
+    except ValueError:
+        raise RequestValidationError('Invalid item')
+    return item.id, item.name, update_date, item.parentId, item.type, item.price
+
+
+def check_unique_ids(data: models.ShopUnitImportRequest):
+    ids = list(map(lambda x: x.id, data.items))
+    if len(ids) != len(set(ids)):
+        raise RequestValidationError('Duplicate ids')
+
+
+@app.post('/imports/async', responses=responses.imports_async_responses, status_code=202,
+          tags=[models.Tags.additional])
+async def imports_async(data: models.ShopUnitImportRequest,
+                        connection: RequestConnection = Depends(request_connection)):
+    """ Проверяет импорт и ставит его в очередь, не дожидаясь применения. Задания выполняются по одному
+    в порядке поступления; ошибки, которые выявляются только при записи (например, родитель - товар),
+    отклоняют задание целиком. Состояние - в `/imports/jobs/{id}`. """
+
+    db = MMDatabase()
+    check_unique_ids(data)
+    job = await db.add_import_job(serialization.import_items(data.items), data.updateDate, len(data.items),
+                                  await connection.get())
+    app.state.import_jobs_added.set()
+    return Response(content=serialization.import_job(job), status_code=202, media_type='application/json')
+
+
+@app.get('/imports/jobs/{id}', responses=responses.import_job_responses, tags=[models.Tags.additional])
+async def import_job(id: models.UUID =
+                     Path(description='Идентификатор задания', example='3fa85f64-5717-4562-b3fc-2c963f66a555'),
+                     connection: RequestConnection = Depends(request_connection)):
+    """ Состояние асинхронного импорта """
+
+    # с основного сервера: реплика может еще не видеть только что поставленное задание
+    db = MMDatabase()
+    job = await db.get_import_job(id, await connection.get())
+    if job is None:
+        return JSONResponse(content=models.Error(code=404, message='Job not found').dict(), status_code=404)
+    return Response(content=serialization.import_job(job), media_type='application/json')
 
 
 @app.delete('/delete/{id}', responses=responses.delete_responses, tags=[models.Tags.main])
 async def delete(id: models.UUID =
-                 Path(description='Идентификатор', example='3fa85f64-5717-4562-b3fc-2c963f66a333')):
+                 Path(description='Идентификатор', example='3fa85f64-5717-4562-b3fc-2c963f66a333'),
+                 connection: RequestConnection = Depends(request_connection)):
     """ Удалить элемент по идентификатору. При удалении категории удаляются все дочерние элементы. """
 
     db = MMDatabase()
-    if not await db.item_exists(id):
+    if not await db.delete_item(id, await connection.get()):
         return JSONResponse(content=models.Error(code=404, message='Item not found').dict(), status_code=404)
-    await db.delete_item(id)
+    app.state.purge_requested.set()
+    await SubtreeCache().sync()
 
 
 @app.get('/nodes/{id}', responses=responses.nodes_responses, tags=[models.Tags.main])
 async def nodes(id: models.UUID =
-                Path(description='Идентификатор', example='3fa85f64-5717-4562-b3fc-2c963f66a333')):
+                Path(description='Идентификатор', example='3fa85f64-5717-4562-b3fc-2c963f66a333'),
+                connection: RequestConnection = Depends(request_connection)):
     """ Получить информацию об элементе по идентификатору.
     При получении информации о категории также предоставляется информация о её дочерних элементах. """
 
-    async def get_item_hierarchy(db_record):
-        item = models.ShopUnit(**db_record, children=None)
-        if item.type == models.ShopUnitType.offer:
-            return item
-        item.children = list()
-        children = await db.get_item_children(item.id)
-        for child in children:
-            print(child)
-            item.children.append(await get_item_hierarchy(child))
-        return item
-
     db = MMDatabase()
-    if not await db.item_exists(id):
+    cache = SubtreeCache()
+    body = cache.get(id)
+    if body is not None:
+        return Response(content=body, media_type='application/json')
+    generation = cache.generation
+    read_connection = await connection.read()
+    # Позиция реплики до чтения: поддерево отражает как минимум ее
+    lsn = await db.get_wal_lsn(read_connection) if connection.replica and cache.enabled else None
+    records = await db.get_subtree(id, read_connection)
+    if not records:
         return JSONResponse(content=models.Error(code=404, message='Item not found').dict(), status_code=404)
 
-    item = await db.get_item(id)
-    item = await get_item_hierarchy(item)
-    return item
+    body = serialization.subtree(records, id)
+    cache.put(id, body, generation, lsn)
+    return Response(content=body, media_type='application/json')
 
 
 @app.get('/sales', responses=responses.sales_responses, tags=[models.Tags.additional])
-async def sales(date: models.datetime =
-                Query(description='Дата и время запроса.', example='2022-05-28T21:12:01.000Z')):
-    """ Получение списка товаров, цена которых была обновлена за последние 24 часа включительно. """
+async def sales(request: Request,
+                date: models.datetime =
+                Query(description='Дата и время запроса.', example='2022-05-28T21:12:01.000Z'),
+                stream: bool =
+                Query(False, description='Отдавать ответ по частям, читая историю из БД пачками.'),
+                connection: RequestConnection = Depends(request_connection)):
+    """ Получение списка товаров, цена которых была обновлена за последние 24 часа включительно.
+    С заголовком `Accept: application/x-ndjson` товары отдаются потоком, по одному JSON-объекту в строке. """
 
     db = MMDatabase()
-    items = await db.get_last_24h(date)
-    return models.ShopUnitStatisticResponse(items=items)
+    ndjson = NDJSON in request.headers.get('accept', '')
+    if stream or ndjson:
+        batches = db.get_last_24h(date, stream=True, replica=not connection.read_your_writes)
+        return StreamingResponse(stream_units(batches, ndjson),
+                                 media_type=NDJSON if ndjson else 'application/json')
+    items = await db.get_last_24h(date, connection=await connection.read())
+    return Response(content=serialization.statistic_response(items), media_type='application/json')
+
+
+async def stream_units(batches, ndjson: bool):
+    """ Сериализует пачки записей истории по мере чтения из курсора: строками NDJSON
+    либо частями того же документа {"items": [...]}, что и без потоковой передачи """
+    separator = b''
+    if not ndjson:
+        yield b'{"items":['
+    async for records in batches:
+        units = serialization.statistic_units(records)
+        if ndjson:
+            yield b''.join(serialization.dumps(unit) + b'\n' for unit in units)
+        else:
+            yield separator + serialization.dumps(units)[1:-1]
+            separator = b','
+    if not ndjson:
+        yield b']}'
 
 
 @app.get('/node/{id}/statistic', responses=responses.statistic_responses, tags=[models.Tags.additional])
@@ -118,13 +373,76 @@ async def statistics(id: models.UUID =
                            example='2022-05-28T21:12:01.000Z'),
                      dateEnd: models.datetime =
                      Query(None, description='Дата и время конца интервала, для которого считается статистика.',
-                           example='2022-05-28T21:12:01.000Z')):
+                           example='2022-05-28T21:12:01.000Z'),
+                     limit: models.Optional[int] =
+                     Query(None, ge=1, description='Максимальное число записей в ответе. Если записей может быть '
+                                                   'больше, курсор следующей страницы возвращается в заголовке '
+                                                   'X-Next-Cursor.'),
+                     cursor: models.Optional[str] =
+                     Query(None, description='Курсор из заголовка X-Next-Cursor предыдущей страницы.'),
+                     bucket: models.Optional[models.StatisticBucket] =
+                     Query(None, description='Вместо истории вернуть первую, минимальную, максимальную и последнюю '
+                                             'цену за каждый час, день или неделю (UTC). Без постраничного вывода.'),
+                     connection: RequestConnection = Depends(request_connection)):
     """ Получение статистики (истории обновлений) по товару/категории за заданный полуинтервал [from, to).
-    Статистика по удаленным элементам недоступна. """
+    История отдается по возрастанию даты. Статистика по удаленным элементам недоступна. """
 
     db = MMDatabase()
-    if not await db.item_exists(id):
+    if bucket is not None and (limit is not None or cursor is not None):
+        raise RequestValidationError('Bucketed statistic is not paginated')
+    after = decode_cursor(cursor) if cursor is not None else None
+
+    if bucket is not None:
+        buckets = await db.get_statistics_buckets(id, dateStart, dateEnd, bucket, await connection.read())
+        if buckets is None:
+            return JSONResponse(content=models.Error(code=404, message='Item not found').dict(), status_code=404)
+        return Response(content=serialization.statistic_buckets_response(buckets), media_type='application/json')
+    items = await db.get_statistics(id, dateStart, dateEnd, after, limit, await connection.read())
+    if items is None:
         return JSONResponse(content=models.Error(code=404, message='Item not found').dict(), status_code=404)
+    response = Response(content=serialization.statistic_response(items), media_type='application/json')
+    if limit is not None and len(items) == limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(items[-1])
+    return response
+
+
+def encode_cursor(record) -> str:
+    """ Курсор страницы статистики: ключ (item_date, id) последней отданной записи истории """
+    key = f"{record['date'].isoformat()},{record['history_id']}"
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        date, history_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(',')
+        return models.datetime.fromisoformat(date), int(history_id)
+    except ValueError:
+        raise RequestValidationError('Invalid cursor')
+
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics():
+    """ Метрики воркера в текстовом формате Prometheus """
+    db = MMDatabase()
+    body = Metrics().expose(db.pool, db.waiting, SubtreeCache().stats(), db.replica, db.replica_healthy, db.replica_lag)
+    return PlainTextResponse(body, media_type='text/plain; version=0.0.4')
+
+
+def admin_access(x_admin_token: models.Optional[str] = Header(None)):
+    """ Служебные эндпоинты доступны только с токеном ADMIN_TOKEN, если он задан """
+    token = models.EnvSettings().admin_token
+    if token is not None and x_admin_token != token:
+        raise HTTPException(status_code=403)
+
+
+@app.get('/admin/slow-queries', include_in_schema=False, dependencies=[Depends(admin_access)])
+async def slow_queries():
+    """ Последние медленные запросы к БД с планами, от новых к старым """
+    return Response(content=serialization.dumps(SlowQueryLog().list()), media_type='application/json')
+
 
-    items = await db.get_statistics(id, dateStart, dateEnd)
-    return models.ShopUnitStatisticResponse(items=items)
+@app.get('/admin/deleted', include_in_schema=False, dependencies=[Depends(admin_access)])
+async def deleted(connection: RequestConnection = Depends(request_connection)):
+    """ Мягко удаленные поддеревья, ожидающие фоновой очистки """
+    records = await MMDatabase().get_deleted(await connection.get())
+    return Response(content=serialization.dumps([dict(record) for record in records]), media_type='application/json')
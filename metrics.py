@@ -0,0 +1,153 @@
+""" Метрики приложения в текстовом формате Prometheus. Счетчики живут в памяти воркера и обновляются
+без блокировок: наблюдение на горячем пути - поиск в словаре и несколько сложений. """
+from bisect import bisect_left
+from time import perf_counter
+from typing import Dict, Iterable, List, Tuple
+
+# Границы корзин гистограмм задержки, секунды (как по умолчанию в клиентах Prometheus)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Границы корзин числа строк, затронутых импортом
+ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+def sample(name: str, labels: str, value) -> str:
+    return f'{name}{{{labels}}} {value}' if labels else f'{name} {value}'
+
+
+class Histogram(object):
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # значения меток -> [число наблюдений в каждой корзине (без накопления), сумма, количество]
+        self.series: Dict[Tuple, List] = dict()
+
+    def observe(self, labels: Tuple, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def expose(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for values, (counts, total, count) in sorted(self.series.items()):
+            labels = format_labels(self.labels, values)
+            separator = ',' if labels else ''
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield f'{self.name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}'
+            yield f'{self.name}_bucket{{{labels}{separator}le="+Inf"}} {count}'
+            yield sample(f'{self.name}_sum', labels, total)
+            yield sample(f'{self.name}_count', labels, count)
+
+
+class Counter(object):
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series: Dict[Tuple, float] = dict()
+
+    def inc(self, labels: Tuple, value: float = 1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def expose(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for values, value in sorted(self.series.items()):
+            yield sample(self.name, format_labels(self.labels, values), value)
+
+
+def gauge(name: str, help: str, samples: Iterable[Tuple[str, float]]) -> Iterable[str]:
+    """ Мгновенные значения, которые считываются в момент запроса метрик; samples - пары (метки, значение) """
+    yield f'# HELP {name} {help}'
+    yield f'# TYPE {name} gauge'
+    for labels, value in samples:
+        yield sample(name, labels, value)
+
+
+class Metrics(object):
+    """ Реестр метрик воркера. С несколькими воркерами каждый отдает свои значения: при опросе через
+    балансировщик ответ дает тот воркер, на который попал запрос. """
+
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = super().__new__(cls)
+        return cls.instance
+
+    def __init__(self):
+        if not hasattr(self, 'requests'):
+            self.requests = Histogram('mm_http_request_duration_seconds', 'Время обработки HTTP-запроса',
+                                      ('handler', 'method', 'status'), LATENCY_BUCKETS)
+            self.statements = Counter('mm_db_statements_total', 'Выполненные запросы к БД', ('statement', ))
+            self.statement_seconds = Counter('mm_db_statement_seconds_total', 'Суммарное время запросов к БД',
+                                             ('statement', ))
+            self.import_items = Histogram('mm_import_items', 'Элементов в одном импорте', (), ROWS_BUCKETS)
+            self.import_group = Histogram('mm_import_group_requests', 'Импортов в одной групповой записи', (),
+                                          (1, 2, 5, 10, 20, 50))
+            self.import_rows = Histogram('mm_import_rows_touched',
+                                         'Строк, вставленных, измененных и удаленных одним импортом вместе '
+                                         'с триггерами (пересчет предков, история)', ('table', ), ROWS_BUCKETS)
+
+    def observe_statement(self, statement: str, elapsed: float):
+        labels = (statement, )
+        self.statements.inc(labels)
+        self.statement_seconds.inc(labels, elapsed)
+
+    def expose(self, pool=None, waiting: int = 0, cache_stats: dict = None,
+               replica=None, replica_healthy: bool = False, replica_lag: float = None) -> str:
+        lines = []
+        for metric in (self.requests, self.statements, self.statement_seconds, self.import_items, self.import_group,
+                       self.import_rows):
+            lines.extend(metric.expose())
+        if pool is not None:
+            lines.extend(gauge('mm_db_pool_size', 'Открытых соединений пула', [('', pool.get_size())]))
+            lines.extend(gauge('mm_db_pool_idle', 'Свободных соединений пула', [('', pool.get_idle_size())]))
+            lines.extend(gauge('mm_db_pool_max_size', 'Наибольший размер пула', [('', pool.get_max_size())]))
+            lines.extend(gauge('mm_db_pool_waiters', 'Запросов, ожидающих соединение из пула', [('', waiting)]))
+        if replica is not None:
+            lines.extend(gauge('mm_db_replica_pool_size', 'Открытых соединений пула реплики', [('', replica.get_size())]))
+            lines.extend(gauge('mm_db_replica_healthy', 'Чтение идет на реплику: 1 - да, 0 - на основной сервер',
+                               [('', int(replica_healthy))]))
+            if replica_lag is not None:
+                lines.extend(gauge('mm_db_replica_lag_seconds', 'Отставание реплики при последней проверке',
+                                   [('', replica_lag)]))
+        if cache_stats is not None:
+            lines.extend(gauge('mm_nodes_cache', 'Состояние кэша /nodes: записи, байты и счетчики с запуска воркера',
+                               [(f'stat="{key}"', value) for key, value in cache_stats.items()]))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware(object):
+    """ ASGI-middleware: время обработки каждого запроса по обработчику, методу и коду ответа """
+
+    def __init__(self, app):
+        self.app = app
+        self.metrics = Metrics()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            endpoint = scope.get('endpoint')
+            handler = endpoint.__name__ if endpoint is not None else 'none'
+            self.metrics.requests.observe((handler, scope['method'], status[0]), perf_counter() - started)
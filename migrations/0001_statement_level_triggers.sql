@@ -0,0 +1,18 @@
+-- Построчные триггеры каскада заменены триггерами уровня оператора с таблицами переходов
+DROP TRIGGER IF EXISTS write_to_history_trigger ON items;
+DROP TRIGGER IF EXISTS delete_cat ON items;
+DROP FUNCTION IF EXISTS write_to_history();
+DROP FUNCTION IF EXISTS delete_cat_func();
+DROP FUNCTION IF EXISTS update_ancestors(uuid[], uuid[], TIMESTAMP with time zone);
+DO
+$$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_trigger WHERE tgname IN ('update_cat', 'insert_in_cat', 'delete_from_cat') 
+               AND tgrelid = 'items'::regclass AND (tgtype & 1) = 1) THEN 
+        DROP TRIGGER IF EXISTS update_cat ON items;
+        DROP TRIGGER IF EXISTS insert_in_cat ON items;
+        DROP TRIGGER IF EXISTS delete_from_cat ON items;
+    END IF;
+END;
+$$
+LANGUAGE plpgsql;
@@ -0,0 +1,4 @@
+-- Суммы и количества товаров в поддереве категории, из которых считается ее цена
+ALTER TABLE items 
+    ADD COLUMN IF NOT EXISTS offer_sum BIGINT NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS offer_count INT NOT NULL DEFAULT 0;
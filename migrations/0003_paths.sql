@@ -0,0 +1,3 @@
+-- Материализованный путь от корня до элемента (включительно)
+ALTER TABLE items ADD COLUMN IF NOT EXISTS path uuid[] NOT NULL DEFAULT '{}';
+CREATE INDEX IF NOT EXISTS items_path_idx ON items USING GIN (path);
@@ -0,0 +1,11 @@
+-- no-transaction
+-- Индексы для выборки детей, /sales и /node/{id}/statistic. Строятся без блокировки записи;
+-- недостроенный после сбоя индекс (INVALID) удаляется и строится заново.
+DROP INDEX CONCURRENTLY IF EXISTS items_parent_idx;
+CREATE INDEX CONCURRENTLY items_parent_idx ON items ("parentId");
+DROP INDEX CONCURRENTLY IF EXISTS items_history_item_date_idx;
+CREATE INDEX CONCURRENTLY items_history_item_date_idx ON items_history (item_id, item_date);
+DROP INDEX CONCURRENTLY IF EXISTS items_history_type_date_idx;
+CREATE INDEX CONCURRENTLY items_history_type_date_idx ON items_history (item_type, item_date);
+DROP INDEX CONCURRENTLY IF EXISTS items_history_parent_idx;
+CREATE INDEX CONCURRENTLY items_history_parent_idx ON items_history ("item_parentId");
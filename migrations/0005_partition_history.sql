@@ -0,0 +1,27 @@
+-- items_history секционируется по месяцам item_date (границы по UTC). Строки вне созданных секций
+-- попадают в секцию по умолчанию; create_history_partitions() переносит их в помесячные секции.
+ALTER TABLE items_history RENAME TO items_history_legacy;
+ALTER TABLE items_history_legacy DROP CONSTRAINT items_history_pkey;
+ALTER SEQUENCE items_history_id_seq OWNED BY NONE;
+DROP INDEX IF EXISTS items_history_item_date_idx;
+DROP INDEX IF EXISTS items_history_type_date_idx;
+DROP INDEX IF EXISTS items_history_parent_idx;
+
+CREATE TABLE items_history (
+    id INT NOT NULL DEFAULT nextval('items_history_id_seq'),
+    item_id uuid,
+    item_name VARCHAR (255) NOT NULL,
+    item_date TIMESTAMP with time zone NOT NULL,
+    "item_parentId" uuid,
+    item_type item_type NOT NULL,
+    item_price INT,
+    PRIMARY KEY (id, item_date)
+) PARTITION BY RANGE (item_date);
+CREATE TABLE items_history_default PARTITION OF items_history DEFAULT;
+CREATE INDEX items_history_item_date_idx ON items_history (item_id, item_date);
+CREATE INDEX items_history_type_date_idx ON items_history (item_type, item_date);
+CREATE INDEX items_history_parent_idx ON items_history ("item_parentId");
+
+INSERT INTO items_history SELECT * FROM items_history_legacy;
+DROP TABLE items_history_legacy;
+ALTER SEQUENCE items_history_id_seq OWNED BY items_history.id;
@@ -0,0 +1,8 @@
+-- Одна запись истории на элемент и дату: дубликаты удаляются (остается последняя), 
+-- неуникальный индекс (item_id, item_date) заменяется уникальным ограничением для INSERT ... ON CONFLICT
+DELETE FROM items_history AS older USING items_history AS newer 
+WHERE older.item_id = newer.item_id AND older.item_date = newer.item_date AND older.id < newer.id;
+DELETE FROM items_history WHERE item_id IS NULL;
+ALTER TABLE items_history ALTER COLUMN item_id SET NOT NULL;
+DROP INDEX IF EXISTS items_history_item_date_idx;
+ALTER TABLE items_history ADD CONSTRAINT items_history_item_date_key UNIQUE (item_id, item_date);
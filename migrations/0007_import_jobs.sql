@@ -0,0 +1,16 @@
+-- Очередь асинхронных импортов (POST /imports/async). Задания выполняются по одному в порядке поступления (seq);
+-- пакет элементов хранится до выполнения задания, после него остаются статус, число затронутых строк и ошибка
+CREATE TABLE import_jobs (
+    id uuid PRIMARY KEY DEFAULT uuid_generate_v4(),
+    seq bigserial NOT NULL UNIQUE,
+    status VARCHAR (16) NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    update_date TIMESTAMP with time zone NOT NULL,
+    items jsonb,
+    item_count INT NOT NULL,
+    rows_touched jsonb,
+    error TEXT,
+    created TIMESTAMP with time zone NOT NULL DEFAULT now(),
+    started TIMESTAMP with time zone,
+    finished TIMESTAMP with time zone
+);
+CREATE INDEX import_jobs_pending_idx ON import_jobs (seq) WHERE status IN ('queued', 'running');
@@ -0,0 +1,6 @@
+-- Мягко удаленные поддеревья (см. MMDatabase.delete_item): id корня удаленного поддерева. Строки поддерева
+-- скрыты от чтения, пока фоновая очистка не удалит их вместе с историей; затем удаляется и запись здесь
+CREATE TABLE tombstones (
+    id uuid PRIMARY KEY,
+    created TIMESTAMP with time zone NOT NULL DEFAULT now()
+);
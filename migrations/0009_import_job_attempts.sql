@@ -0,0 +1,4 @@
+-- Повтор заданий импорта после взаимоблокировки или конфликта сериализации: число начатых попыток
+-- и время, раньше которого задание не берется снова (см. MMDatabase.process_import_job)
+ALTER TABLE import_jobs ADD COLUMN attempts INT NOT NULL DEFAULT 0;
+ALTER TABLE import_jobs ADD COLUMN retry_after TIMESTAMP with time zone;
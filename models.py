@@ -1,6 +1,6 @@
 from pydantic import BaseModel, UUID4, root_validator, NonNegativeInt
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 from fastapi.exceptions import RequestValidationError
 from pydantic import Field
@@ -24,6 +24,41 @@ class EnvSettings(BaseSettings):
     postgres_user: str
     postgres_password: str
     postgres_port: int
+    postgres_pool_min_size: int = 10
+    postgres_pool_max_size: int = 10
+    postgres_max_inactive_connection_lifetime: float = 300.0  # секунды простоя, после которых соединение закрывается
+    postgres_statement_cache_size: int = 100  # 0 - без кэша подготовленных выражений (например, за pgbouncer)
+    postgres_command_timeout: Optional[float] = None  # секунды; None - без ограничения
+    postgres_application_name: str = 'mega_market'
+    postgres_write_isolation: str = 'read_committed'  # уровень изоляции транзакций записи: read_committed, repeatable_read или serializable
+    postgres_max_connections: int = 100  # max_connections сервера: пулы всех воркеров вместе укладываются в него
+    postgres_reserved_connections: int = 10  # соединения сверх пулов воркеров: суперпользователь, CLI, миграции
+    postgres_replica_host: Optional[str] = None  # реплика для чтения; None - все запросы идут на основной сервер
+    postgres_replica_port: Optional[int] = None  # по умолчанию - postgres_port
+    postgres_replica_db: Optional[str] = None  # по умолчанию - postgres_db
+    postgres_replica_max_lag: float = 5.0  # секунды отставания, после которых чтение переключается на основной сервер
+    postgres_replica_check_interval: float = 1.0  # секунды между проверками реплики
+    web_concurrency: int = 1  # число воркеров приложения; выставляется gunicorn.conf.py
+    history_partitions_ahead: int = 3  # на сколько месяцев вперед заранее создаются секции истории
+    history_retention_days: Optional[int] = None  # история старше выгружается в архив; None - хранить все
+    history_archive_dir: str = 'archive'
+    history_maintenance_interval: int = 3600  # секунды между запусками обслуживания истории
+    nodes_cache_bytes: int = 64 * 1024 * 1024  # размер кэша поддеревьев /nodes; 0 - без кэша
+    slow_query_ms: Optional[float] = 200  # запросы к БД дольше попадают в журнал медленных; None - не вести журнал
+    slow_query_explain_rate: float = 0.05  # доля медленных запросов, для которых снимается план
+    slow_query_explain_timeout: float = 30  # секунды на получение плана
+    slow_query_log_size: int = 100  # сколько последних медленных запросов хранится
+    import_coalesce_ms: float = 2  # сколько /imports копятся для записи одной транзакцией; 0 - каждый отдельно
+    import_coalesce_max_items: int = 10000  # наибольшее число элементов в одной групповой записи
+    import_batch_size: int = 1000  # элементов в пачке, которой /imports/stream пишет во временную таблицу
+    import_jobs_poll_interval: float = 1.0  # секунды между проверками очереди асинхронных импортов
+    import_jobs_max_attempts: int = 5  # попыток задания при взаимоблокировках, после которых оно отклоняется
+    import_jobs_retry_delay: float = 1.0  # секунды до первого повтора задания; каждый следующий вдвое позже
+    soft_delete_min_offers: Optional[int] = 10000  # категории с таким числом товаров удаляются мягко; None - никогда
+    purge_batch_size: int = 1000  # строк items, удаляемых фоновой очисткой в одной транзакции
+    purge_pause: float = 0.1  # секунды между транзакциями фоновой очистки
+    purge_interval: float = 5.0  # секунды между проверками мягко удаленных поддеревьев
+    admin_token: Optional[str] = None  # если задан, /admin/* требуют заголовок X-Admin-Token с этим значением
 
     class Config:
         env_file = ".env"
@@ -89,6 +124,37 @@ class ShopUnitImportRequest(BaseModel):
         }
 
 
+class ImportJobStatus(str, Enum):
+    """ Состояние асинхронного импорта """
+    queued = 'queued'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+
+
+class ImportJob(BaseModel):
+    id: UUID = Field(description='Идентификатор задания', nullable=False, example='3fa85f64-5717-4562-b3fc-2c963f66a555')
+    status: ImportJobStatus = Field(description='queued - ждет в очереди, running - выполняется, done - выполнено, '
+                                                'failed - отклонено, изменения не применены', nullable=False)
+    items: int = Field(description='Элементов в импорте', nullable=False)
+    ahead: Optional[int] = Field(description='Сколько заданий выполнится раньше, пока задание ждет в очереди',
+                                 nullable=True)
+    attempts: int = Field(description='Начатых попыток выполнения', nullable=False)
+    rows: Optional[Dict[str, int]] = Field(description='Строк, вставленных, измененных и удаленных импортом '
+                                                       'по таблицам (вместе с пересчетом предков и историей)',
+                                           nullable=True)
+    error: Optional[str] = Field(description='Причина отказа для failed; для задания, ожидающего повтора, '
+                                             '- ошибка последней попытки', nullable=True)
+    created: datetime = Field(description='Время постановки в очередь', nullable=False)
+    started: Optional[datetime] = Field(description='Время начала выполнения', nullable=True)
+    finished: Optional[datetime] = Field(description='Время завершения', nullable=True)
+
+    class Config:
+        json_encoders = {
+            datetime: lambda x: x.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        }
+
+
 class ShopUnitStatisticUnit(BaseModel):
     id: UUID = ID_FIELD
     name: str = NAME_FIELD
@@ -112,6 +178,35 @@ class ShopUnitStatisticResponse(BaseModel):
         }
 
 
+class StatisticBucket(str, Enum):
+    """ Интервал агрегации статистики """
+    hour = 'hour'
+    day = 'day'
+    week = 'week'
+
+
+class ShopUnitStatisticBucket(BaseModel):
+    date: datetime = Field(description='Начало интервала (UTC)', nullable=False, example='2022-05-28T21:00:00.000Z')
+    open: Optional[NonNegativeInt] = Field(description='Первая цена за интервал', nullable=True)
+    min: Optional[NonNegativeInt] = Field(description='Минимальная цена за интервал', nullable=True)
+    max: Optional[NonNegativeInt] = Field(description='Максимальная цена за интервал', nullable=True)
+    last: Optional[NonNegativeInt] = Field(description='Последняя цена за интервал', nullable=True)
+
+    class Config:
+        json_encoders = {
+            datetime: lambda x: x.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        }
+
+
+class ShopUnitStatisticBucketResponse(BaseModel):
+    items: List[ShopUnitStatisticBucket] = Field(description='Цены по интервалам в порядке времени.', nullable=False)
+
+    class Config:
+        json_encoders = {
+            datetime: lambda x: x.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        }
+
+
 class Error(BaseModel):
     code: int
     message: str
@@ -1,3 +1,4 @@
+from typing import Union
 import models
 from models import Error
 
@@ -25,8 +26,21 @@ default404 = {
     }
 }
 
+default409 = {
+    409: {
+        "model": Error,
+        "description": "Элемент удален вместе с большим поддеревом, которое еще очищается; импорт можно повторить позже.",
+        "content": {
+            "application/json": {
+                "example": Error(code=409, message='Item is being deleted'),
+            }
+        }
+    }
+}
+
 imports_responses = {
     **default400,
+    **default409,
     200: {
             "description": "Вставка или обновление прошли успешно.",
             "content": None
@@ -34,6 +48,30 @@ imports_responses = {
 
 }
 
+imports_async_responses = {
+    **default400,
+    202: {
+            "model": models.ImportJob,
+            "description": "Импорт проверен и поставлен в очередь.",
+    },
+}
+
+import_job_responses = {
+    200: {
+            "model": models.ImportJob,
+            "description": "Состояние задания импорта.",
+    },
+    404: {
+        "model": Error,
+        "description": "Задание не найдено.",
+        "content": {
+            "application/json": {
+                "example": Error(code=404, message='Job not found'),
+            }
+        }
+    },
+}
+
 delete_responses = {
     **default400,
     **default404,
@@ -97,6 +135,11 @@ sales_responses = {
     200: {
             "model": models.ShopUnitStatisticResponse,
             "description": "Список товаров, цена которых была обновлена.",
+            "content": {
+                "application/x-ndjson": {
+                    "schema": {"$ref": "#/components/schemas/ShopUnitStatisticUnit"}
+                }
+            },
             # "content": {
             #     "application/json": {
             #         "example": {
@@ -119,8 +162,14 @@ sales_responses = {
 statistic_responses = {
     **default404,
     200: {
-            "model": models.ShopUnitStatisticResponse,
-            "description": "Статистика по элементу.",
+            "model": Union[models.ShopUnitStatisticResponse, models.ShopUnitStatisticBucketResponse],
+            "description": "Статистика по элементу. С параметром bucket - цены по интервалам.",
+            "headers": {
+                "X-Next-Cursor": {
+                    "description": "Курсор следующей страницы, если задан limit и записей может быть больше.",
+                    "schema": {"type": "string"},
+                }
+            },
             # "content": {
             #     "items": [
             #         {
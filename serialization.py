@@ -0,0 +1,74 @@
+""" Сериализация записей asyncpg в JSON через orjson, без построения pydantic-моделей.
+Данные в БД уже проверены при импорте, поэтому повторная валидация не нужна; формат ответа
+совпадает с тем, что дают модели из models.py (даты - как в их json_encoders). """
+from datetime import datetime
+from functools import lru_cache
+from typing import Iterable, List
+from uuid import UUID
+from asyncpg import Record
+import orjson
+
+# Поля ShopUnitStatisticUnit в порядке модели; запросы истории выбирают колонки в том же порядке
+STATISTIC_UNIT_FIELDS = ('id', 'name', 'parentId', 'type', 'price', 'date')
+
+
+@lru_cache(maxsize=4096)
+def format_date(value: datetime) -> str:
+    """ 2022-05-28T21:12:01.000Z; у многих записей даты совпадают, поэтому результат кэшируется """
+    return value.isoformat(timespec='milliseconds')[:23] + 'Z'
+
+
+def default(value):
+    if isinstance(value, datetime):
+        return format_date(value)
+    if isinstance(value, UUID):
+        # asyncpg отдает собственный подкласс UUID, который orjson не сериализует сам
+        return str(value)
+    raise TypeError
+
+
+def dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def subtree(records: Iterable[Record], root) -> bytes:
+    """ ShopUnit с вложенными children из плоского списка записей поддерева """
+    units = dict()
+    for record in records:
+        unit = dict(record)
+        unit['children'] = list() if unit['type'] == 'CATEGORY' else None
+        units[unit['id']] = unit
+    for unit in units.values():
+        if unit['id'] != root:
+            # элемент, импортированный с родителем-товаром, в поддерево не входит
+            parent = units.get(unit['parentId'])
+            if parent is not None and parent['children'] is not None:
+                parent['children'].append(unit)
+    return dumps(units[root])
+
+
+def statistic_units(records: Iterable[Record]) -> List[dict]:
+    """ Записи истории как ShopUnitStatisticUnit; лишние колонки в конце записи (history_id) отбрасываются """
+    return [dict(zip(STATISTIC_UNIT_FIELDS, record)) for record in records]
+
+
+def statistic_response(records: Iterable[Record]) -> bytes:
+    return dumps({'items': statistic_units(records)})
+
+
+def statistic_buckets_response(records: Iterable[Record]) -> bytes:
+    return dumps({'items': [dict(record) for record in records]})
+
+
+def import_job(record: Record) -> bytes:
+    """ ImportJob; число затронутых строк хранится в jsonb и приходит из asyncpg строкой """
+    job = dict(record)
+    if job['rows'] is not None:
+        job['rows'] = orjson.loads(job['rows'])
+    return dumps(job)
+
+
+def import_items(items) -> str:
+    """ Элементы импорта (ShopUnitImport) JSON-массивом для очереди асинхронных импортов """
+    return dumps([{'id': item.id, 'name': item.name, 'parentId': item.parentId, 'type': item.type,
+                   'price': item.price} for item in items]).decode()
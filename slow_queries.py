@@ -0,0 +1,57 @@
+""" Журнал медленных запросов к БД: запросы дольше порога пишутся в лог и в кольцевой буфер,
+часть из них дополняется планом EXPLAIN (см. DatabaseCore.explain). Значения параметров
+не сохраняются - только их типы и размеры. """
+import logging
+import random
+import re
+from collections import deque
+from datetime import datetime, timezone
+from typing import Iterable, List
+import models
+
+logger = logging.getLogger(__name__)
+
+# Запросы, для которых можно получить план; DDL и блоки DO не объясняются
+EXPLAINABLE = re.compile(r'^\s*(SELECT|WITH|INSERT|UPDATE|DELETE|VALUES)\b', re.IGNORECASE)
+
+
+def parameter_shape(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return f'{type(value).__name__}[{len(value)}]'
+    if isinstance(value, (str, bytes)):
+        return f'{type(value).__name__}({len(value)})'
+    return type(value).__name__
+
+
+class SlowQueryLog(object):
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = super().__new__(cls)
+        return cls.instance
+
+    def __init__(self):
+        if not hasattr(self, 'entries'):
+            env = models.EnvSettings()
+            self.threshold = env.slow_query_ms / 1000 if env.slow_query_ms is not None else None
+            self.explain_rate = env.slow_query_explain_rate
+            self.explain_timeout = env.slow_query_explain_timeout
+            self.entries: deque = deque(maxlen=env.slow_query_log_size)
+            # План получается по одному за раз, чтобы EXPLAIN ANALYZE не нагружал БД сам
+            self.explaining = False
+
+    def add(self, statement: str, command: str, args: Iterable, elapsed: float, executemany: bool = False) -> dict:
+        sql = ' '.join(command.split())
+        shapes = [f'rows[{len(args)}]'] if executemany else [parameter_shape(arg) for arg in args]
+        entry = {'date': datetime.now(timezone.utc), 'statement': statement, 'duration_ms': round(elapsed * 1000, 3),
+                 'parameters': shapes, 'sql': sql, 'plan': None}
+        self.entries.append(entry)
+        logger.warning('Медленный запрос %s: %.1f мс, параметры (%s): %s',
+                       statement, elapsed * 1000, ', '.join(shapes), sql)
+        return entry
+
+    def should_explain(self, command: str) -> bool:
+        return not self.explaining and random.random() < self.explain_rate and bool(EXPLAINABLE.match(command))
+
+    def list(self) -> List[dict]:
+        """ Записи от новых к старым """
+        return list(reversed(self.entries))
@@ -30,10 +30,28 @@ def imports(data: dict) -> requests.Response:
     return simple_request(Methods.post, '/imports', data=data)
 
 
+def imports_async(data: dict) -> requests.Response:
+    return simple_request(Methods.post, '/imports/async', data=data)
+
+
+def imports_stream(items: list, update_date: str) -> requests.Response:
+    body = ''.join(json.dumps(item) + '\n' for item in items)
+    return requests.post(f'{PROTOCOL}://{HOST}:{PORT}/imports/stream', params={'updateDate': update_date}, data=body,
+                         headers={'Content-Type': 'application/x-ndjson'})
+
+
+def import_job(id: str) -> requests.Response:
+    return simple_request(Methods.get, f'/imports/jobs/{id}')
+
+
 def delete(id: str) -> requests.Response:
     return simple_request(Methods.delete, f'/delete/{id}')
 
 
+def deleted() -> requests.Response:
+    return simple_request(Methods.get, '/admin/deleted')
+
+
 def nodes(id: str) -> requests.Response:
     return simple_request(Methods.get, f'/nodes/{id}')
 
@@ -42,5 +60,8 @@ def sales(date: str) -> requests.Response:
     return simple_request(Methods.get, '/sales', params={'date': date})
 
 
-def statistics(id: str, date_start: str = None, date_end: str = None) -> requests.Response:
-    return simple_request(Methods.get, f'/node/{id}/statistic', params={'dateStart': date_start, 'dateEnd': date_end})
+def statistics(id: str, date_start: str = None, date_end: str = None,
+               limit: int = None, cursor: str = None, bucket: str = None) -> requests.Response:
+    return simple_request(Methods.get, f'/node/{id}/statistic', params={'dateStart': date_start, 'dateEnd': date_end,
+                                                                        'limit': limit, 'cursor': cursor,
+                                                                        'bucket': bucket})
@@ -1,5 +1,11 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pprint import pprint
 from api import *
+import asyncpg
 
 
 class ColorsMeta(type):
@@ -22,6 +28,10 @@ class CT(metaclass=ColorsMeta):
     italic = 3
 
 
+class Skipped(Exception):
+    """ Тесту нужно то, чего нет в окружении (например, доступ к БД сервиса) """
+
+
 class test(object):
     methods = []
 
@@ -39,6 +49,9 @@ class test(object):
         except AssertionError as ex:
             print(CT.red('Failed: ') + ''.join(ex.args))
             return
+        except Skipped as ex:
+            print(CT.blue('Skipped: ') + ''.join(ex.args))
+            return
         else:
             print(CT.green('Passed'))
         finally:
@@ -512,12 +525,319 @@ def test_statistics():
     assert stats_json == ROOT_STATS, '/statistic does not work =('
 
 
+@test
+def test_statistics_pages():
+    items, cursor = [], None
+    while True:
+        resp = statistics(ROOT, limit=3, cursor=cursor)
+        items += resp.json()['items']
+        cursor = resp.headers.get('X-Next-Cursor')
+        if cursor is None:
+            break
+    ROOT_STATS['items'].sort(key=lambda x: x['date'])
+    assert items == ROOT_STATS['items'], '/statistic pages do not work =('
+
+
+@test
+def test_statistics_buckets():
+    stats_json = statistics(ROOT, bucket='day').json()
+    expected = [{'date': item['date'][:10] + 'T00:00:00.000Z', 'open': item['price'], 'min': item['price'],
+                 'max': item['price'], 'last': item['price']} for item in ROOT_STATS['items']]
+    assert stats_json == {'items': expected}, '/statistic buckets do not work =('
+
+
+@test
+def test_child_of_offer():
+    category = '3fa85f64-5717-4562-b3fc-0000000000e1'
+    offer = '3fa85f64-5717-4562-b3fc-0000000000e2'
+    orphan = '3fa85f64-5717-4562-b3fc-0000000000e3'
+    imports({'items': [{'id': orphan, 'name': 'Товар', 'parentId': offer, 'type': 'OFFER', 'price': 1000}],
+             'updateDate': '2022-02-06T12:00:00.000Z'})
+    imports({'items': [{'id': category, 'name': 'Категория', 'parentId': None, 'type': 'CATEGORY'},
+                       {'id': offer, 'name': 'Товар', 'parentId': category, 'type': 'OFFER', 'price': 100}],
+             'updateDate': '2022-02-06T13:00:00.000Z'})
+    resp = nodes(offer)
+    assert resp.status_code == 200 and resp.json()['children'] is None, 'У товара не может быть дочерних элементов'
+    node = nodes(category).json()
+    assert node['price'] == 100 and [child['id'] for child in node['children']] == [offer], \
+        'Элемент с родителем-товаром не входит в поддерево категории'
+    delete(category)
+    delete(orphan)
+
+
+@test
+def test_concurrent_imports():
+    category = '3fa85f64-5717-4562-b3fc-0000000000c1'
+    offer = '3fa85f64-5717-4562-b3fc-0000000000c2'
+    imports({'items': [{'id': category, 'name': 'Категория', 'parentId': None, 'type': 'CATEGORY'},
+                       {'id': offer, 'name': 'Товар', 'parentId': category, 'type': 'OFFER', 'price': 10}],
+             'updateDate': '2022-02-03T12:00:00.000Z'})
+    batches = [{'items': [{'id': f'3fa85f64-5717-4562-b3fc-0000000002{i:02}', 'name': 'Товар', 'parentId': category,
+                           'type': 'OFFER', 'price': 10}], 'updateDate': '2022-02-03T13:00:00.000Z'}
+               for i in range(8)]
+    batches[3]['items'][0]['parentId'] = offer
+    with ThreadPoolExecutor(len(batches)) as executor:
+        statuses = [resp.status_code for resp in executor.map(imports, batches)]
+    assert statuses == [200, 200, 200, 400, 200, 200, 200, 200], \
+        'Каждый из одновременных импортов должен получить свой результат'
+    node = nodes(category).json()
+    assert len(node['children']) == 8 and node['price'] == 10, 'Одновременные импорты должны примениться все'
+    # импорты с разными датами не должны сливаться в одну запись истории категории
+    batches = [{'items': [{'id': f'3fa85f64-5717-4562-b3fc-0000000002{i:02}', 'name': 'Товар', 'parentId': category,
+                           'type': 'OFFER', 'price': 10}], 'updateDate': f'2022-02-03T1{4 + i % 2}:00:00.000Z'}
+               for i in range(8)]
+    with ThreadPoolExecutor(len(batches)) as executor:
+        statuses = [resp.status_code for resp in executor.map(imports, batches)]
+    assert statuses == [200] * 8, 'Одновременные импорты должны примениться все'
+    dates = {item['date'] for item in statistics(category).json()['items']}
+    assert {'2022-02-03T14:00:00.000Z', '2022-02-03T15:00:00.000Z'} <= dates, \
+        'Каждый из одновременных импортов должен записать историю категории со своей датой'
+    delete(category)
+
+
+@test
+def test_imports_stream():
+    category = '3fa85f64-5717-4562-b3fc-0000000000b1'
+    offers = [f'3fa85f64-5717-4562-b3fc-0000000001{i:02}' for i in range(10)]
+    items = [{'id': offer, 'name': 'Товар', 'parentId': category, 'type': 'OFFER', 'price': i * 10}
+             for i, offer in enumerate(offers)]
+    items.append({'id': category, 'name': 'Категория', 'parentId': None, 'type': 'CATEGORY'})
+    resp = imports_stream(items, '2022-02-02T12:00:00.000Z')
+    assert resp.status_code == 200, '/imports/stream does not work =('
+    node = nodes(category).json()
+    assert node['price'] == 45 and len(node['children']) == 10, 'Импорт NDJSON должен примениться целиком'
+    resp = imports_stream([items[0], items[0]], '2022-02-02T13:00:00.000Z')
+    assert resp.json() == ERRS['validation'], 'Повторный id в импорте NDJSON'
+    resp = imports_stream([{**items[0], 'price': 1}, {**items[1], 'price': None}], '2022-02-02T13:00:00.000Z')
+    assert resp.json() == ERRS['validation'], 'Невалидный элемент отклоняет импорт NDJSON целиком'
+    assert nodes(offers[0]).json()['price'] == 0, 'Невалидный импорт не должен применяться частично'
+    delete(category)
+
+
+def wait_import_job(job_id: str, timeout: float = 10) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        job = import_job(job_id).json()
+        if job['status'] in ('done', 'failed') or time.monotonic() > deadline:
+            return job
+        time.sleep(0.1)
+
+
+@test
+def test_imports_async():
+    category = '3fa85f64-5717-4562-b3fc-0000000000a1'
+    offer = '3fa85f64-5717-4562-b3fc-0000000000a2'
+    first = imports_async({'items': [{'id': category, 'name': 'Категория', 'parentId': None, 'type': 'CATEGORY'},
+                                     {'id': offer, 'name': 'Товар', 'parentId': category, 'type': 'OFFER',
+                                      'price': 100}],
+                           'updateDate': '2022-02-01T12:00:00.000Z'})
+    assert first.status_code == 202, '/imports/async does not work =('
+    wrong = imports_async({'items': [{**base_item, 'id': '3fa85f64-5717-4562-b3fc-0000000000a3', 'parentId': offer}],
+                           'updateDate': '2022-02-01T13:00:00.000Z'})
+    second = imports_async({'items': [{'id': offer, 'name': 'Товар', 'parentId': category, 'type': 'OFFER',
+                                       'price': 300}],
+                            'updateDate': '2022-02-01T14:00:00.000Z'})
+    jobs = [wait_import_job(resp.json()['id']) for resp in (first, wrong, second)]
+    assert [job['status'] for job in jobs] == ['done', 'failed', 'done'], \
+        'Задания импорта должны выполняться по порядку, ошибочное - отклоняться'
+    assert jobs[0]['rows']['items'] >= 2, 'Задание должно сообщать число затронутых строк'
+    node = nodes(category).json()
+    assert node['price'] == 300 and node['date'] == '2022-02-01T14:00:00.000Z', \
+        'Последнее по порядку задание должно примениться последним'
+    assert import_job('3fa85f64-5717-4562-b3fc-0000000000a4').status_code == 404
+    assert imports_async({'items': [base_item, base_item], 'updateDate': '2022-02-01T12:00:00.000Z'}).status_code \
+        == 400, 'Импорт проверяется до постановки в очередь'
+    delete(category)
+
+
+async def connect() -> asyncpg.Connection:
+    """ Прямое подключение к БД сервиса; задается переменными POSTGRES_*, как у приложения """
+    if 'POSTGRES_HOST' not in os.environ:
+        raise Skipped('нужен доступ к БД сервиса (переменные POSTGRES_*, как у приложения)')
+    return await asyncpg.connect(host=os.environ['POSTGRES_HOST'], port=os.environ.get('POSTGRES_PORT'),
+                                 user=os.environ.get('POSTGRES_USER'), password=os.environ.get('POSTGRES_PASSWORD'),
+                                 database=os.environ.get('POSTGRES_DB'))
+
+
+def database(*commands: str):
+    """ Выполняет команды прямо в БД сервиса """
+    async def execute():
+        connection = await connect()
+        try:
+            for command in commands:
+                await connection.execute(command)
+        finally:
+            await connection.close()
+
+    asyncio.run(execute())
+
+
+@contextmanager
+def holding(command: str):
+    """ Выполняет command в прямом подключении к БД сервиса и держит подключение открытым,
+    например, чтобы не отпускать взятую advisory-блокировку """
+    loop = asyncio.new_event_loop()
+    try:
+        connection = loop.run_until_complete(connect())
+        try:
+            loop.run_until_complete(connection.execute(command))
+            yield
+        finally:
+            loop.run_until_complete(connection.close())
+    finally:
+        loop.close()
+
+
+@test
+def test_import_job_retries():
+    category = '3fa85f64-5717-4562-b3fc-0000000000b1'
+    flaky = '3fa85f64-5717-4562-b3fc-0000000000b2'
+    broken = '3fa85f64-5717-4562-b3fc-0000000000b3'
+    # триггер откатывает транзакцию задания так же, как взаимоблокировка: первые две вставки flaky
+    # и все вставки broken завершаются ошибкой serialization_failure
+    database('''CREATE SEQUENCE test_job_rollbacks;''', f'''
+    CREATE FUNCTION test_job_rollback() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.id = '{broken}' THEN
+            RAISE EXCEPTION 'Тестовый конфликт' USING ERRCODE = 'serialization_failure';
+        END IF;
+        IF NEW.id = '{flaky}' AND nextval('test_job_rollbacks') <= 2 THEN
+            RAISE EXCEPTION 'Тестовый конфликт' USING ERRCODE = 'serialization_failure';
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;''', '''
+    CREATE TRIGGER test_job_rollback BEFORE INSERT ON items FOR EACH ROW EXECUTE FUNCTION test_job_rollback();''')
+    try:
+        retried = imports_async({'items': [{'id': category, 'name': 'Категория', 'parentId': None, 'type': 'CATEGORY'},
+                                           {'id': flaky, 'name': 'Товар', 'parentId': category, 'type': 'OFFER',
+                                            'price': 100}],
+                                 'updateDate': '2022-02-01T12:00:00.000Z'})
+        rejected = imports_async({'items': [{'id': broken, 'name': 'Товар', 'parentId': category, 'type': 'OFFER',
+                                             'price': 300}],
+                                  'updateDate': '2022-02-01T13:00:00.000Z'})
+        retried = wait_import_job(retried.json()['id'], 30)
+        rejected = wait_import_job(rejected.json()['id'], 60)
+    finally:
+        database('''DROP TRIGGER test_job_rollback ON items;''', '''DROP FUNCTION test_job_rollback();''',
+                 '''DROP SEQUENCE test_job_rollbacks;''')
+    assert retried['status'] == 'done' and retried['attempts'] == 3, \
+        'Задание, откаченное из-за конфликта, должно повторяться'
+    assert rejected['status'] == 'failed' and rejected['attempts'] > 1 and rejected['error'] == 'Тестовый конфликт', \
+        'Задание должно отклоняться после import_jobs_max_attempts попыток'
+    assert nodes(category).json()['price'] == 100
+    delete(category)
+
+
+@test
+def test_delete_and_reimport():
+    # сервис для тестов запускается с SOFT_DELETE_MIN_OFFERS=1, и категория удаляется мягко
+    parent = '3fa85f64-5717-4562-b3fc-0000000000d0'
+    category = '3fa85f64-5717-4562-b3fc-0000000000d1'
+    offers = [f'3fa85f64-5717-4562-b3fc-0000000003{i:02}' for i in range(4)]
+    items = [{'id': parent, 'name': 'Категория', 'parentId': None, 'type': 'CATEGORY'},
+             {'id': '3fa85f64-5717-4562-b3fc-0000000000d2', 'name': 'Товар', 'parentId': parent, 'type': 'OFFER',
+              'price': 300},
+             {'id': category, 'name': 'Категория', 'parentId': parent, 'type': 'CATEGORY'}]
+    items += [{'id': offer, 'name': 'Товар', 'parentId': category, 'type': 'OFFER', 'price': 100}
+              for offer in offers]
+    imports({'items': items, 'updateDate': '2022-02-04T12:00:00.000Z'})
+    assert nodes(parent).json()['price'] == 140
+    assert delete(category).status_code == 200, '/delete does not work =('
+    assert nodes(parent).json()['price'] == 300, 'Цена предков должна обновиться сразу после удаления'
+    assert nodes(category).status_code == 404 and statistics(offers[0]).status_code == 404, \
+        'Удаленное поддерево не должно быть доступно'
+    assert delete(offers[0]).status_code == 404, 'Элемент удаленного поддерева уже удален'
+    assert all(item['id'] not in offers for item in sales('2022-02-04T12:00:00.000Z').json()['items']), \
+        '/sales не должен возвращать удаленные товары'
+    for _ in range(100):
+        if all(tombstone['id'] != category for tombstone in deleted().json()):
+            break
+        time.sleep(0.1)
+    else:
+        assert False, 'Фоновая очистка должна удалить строки поддерева'
+
+    # повторный импорт сразу после удаления удаляет еще не очищенное поддерево сам
+    imports({'items': items[2:4], 'updateDate': '2022-02-05T12:00:00.000Z'})
+    assert delete(category).status_code == 200
+    imports({'items': items[2:4], 'updateDate': '2022-02-06T12:00:00.000Z'})
+    node = nodes(category).json()
+    assert node['price'] == 100 and len(node['children']) == 1, \
+        'Повторный импорт удаленных элементов должен создать их заново'
+    assert [item['date'] for item in statistics(offers[0]).json()['items']] == ['2022-02-06T12:00:00.000Z'], \
+        'История удаленного товара не должна вернуться'
+    assert nodes(parent).json()['price'] == 200
+    delete(parent)
+
+
+@test
+def test_deleted_subtree_reuse():
+    # при PURGE_BATCH_SIZE по умолчанию (1000) поддерево с 1001 товаром не очищается импортом синхронно
+    parent = '3fa85f64-5717-4562-b3fc-0000000000e0'
+    category = '3fa85f64-5717-4562-b3fc-0000000000e1'
+    nested = '3fa85f64-5717-4562-b3fc-0000000000e2'
+    other = '3fa85f64-5717-4562-b3fc-0000000000e3'
+    old_offer = '3fa85f64-5717-4562-b3fc-0000000000e4'
+    new_offer = '3fa85f64-5717-4562-b3fc-0000000000e5'
+    items = [{'id': parent, 'name': 'Категория', 'parentId': None, 'type': 'CATEGORY'},
+             {'id': category, 'name': 'Категория', 'parentId': parent, 'type': 'CATEGORY'},
+             {'id': nested, 'name': 'Категория', 'parentId': category, 'type': 'CATEGORY'},
+             {'id': old_offer, 'name': 'Товар', 'parentId': nested, 'type': 'OFFER', 'price': 100}]
+    items += [{'id': f'3fa85f64-5717-4562-b3fd-{i:012}', 'name': 'Товар', 'parentId': category, 'type': 'OFFER',
+               'price': 100} for i in range(1001)]
+    imports({'items': items, 'updateDate': '2022-02-07T12:00:00.000Z'})
+    # пока тест держит advisory-блокировку фоновой очистки (PURGE_LOCK_ID), удаленное поддерево не очищается
+    with holding('''SELECT pg_advisory_lock(1296912469);'''):
+        assert delete(category).status_code == 200
+        if all(tombstone['id'] != category for tombstone in deleted().json()):
+            delete(parent)
+            raise Skipped('категория удалена сразу: сервис запущен без SOFT_DELETE_MIN_OFFERS=1')
+
+        reimport = imports({'items': [{'id': other, 'name': 'Категория', 'parentId': None, 'type': 'CATEGORY'},
+                                      {**items[2], 'parentId': other},
+                                      {'id': new_offer, 'name': 'Товар', 'parentId': nested, 'type': 'OFFER',
+                                       'price': 300}],
+                            'updateDate': '2022-02-08T12:00:00.000Z'})
+        assert reimport.status_code == 200, 'Элемент удаленного поддерева можно импортировать заново, не дожидаясь очистки'
+        assert [child['id'] for child in nodes(nested).json()['children']] == [new_offer] and \
+            statistics(old_offer).status_code == 404, 'Прежние потомки повторно импортированного элемента остаются удаленными'
+        assert nodes(other).json()['price'] == 300
+
+        conflict = imports({'items': [items[1]], 'updateDate': '2022-02-08T12:00:00.000Z'})
+        assert conflict.status_code == 409, \
+            'Корень большого удаленного поддерева нельзя импортировать заново, пока оно не очищено'
+        assert delete(parent).status_code == 200 and nodes(parent).status_code == 404, \
+            'Предок удаленного поддерева удаляется сразу'
+        assert [tombstone['rows'] for tombstone in deleted().json() if tombstone['id'] == category] == [1003], \
+            'Удаленное поддерево внутри удаляемого остается фоновой очистке'
+    for _ in range(100):
+        if all(tombstone['id'] != category for tombstone in deleted().json()):
+            break
+        time.sleep(0.1)
+    else:
+        assert False, 'Фоновая очистка должна удалить строки поддерева'
+    assert imports({'items': [{**items[1], 'parentId': None}], 'updateDate': '2022-02-09T12:00:00.000Z'}).status_code \
+        == 200
+    assert nodes(category).json()['children'] == [], 'Очищенное поддерево не должно вернуться'
+    delete(category)
+    delete(other)
+
+
 def main():
     test_imports()
     test_nodes_and_avg_price()
     test_delete()
     test_sales()
     test_statistics()
+    test_statistics_pages()
+    test_statistics_buckets()
+    test_child_of_offer()
+    test_concurrent_imports()
+    test_imports_stream()
+    test_imports_async()
+    test_import_job_retries()
+    test_delete_and_reimport()
+    test_deleted_subtree_reuse()
 
     test_same_ids()
     test_wrong_parent()